@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous Rendering.
+-----------------------
+`Tortoise.render_async(ctx)` renders a template in a coroutine, with a
+context whose values may be awaitables or coroutine functions, anywhere
+along a dotted path:
+
+    async def load_user():
+        ...
+
+    await template.render_async({'user': load_user, 'posts': fetch()})
+
+A value is only awaited once the render gets to it, so the queries
+behind an If branch that isn't taken never run. Each awaitable is
+awaited once per render however often the template refers to it, and
+a coroutine function is called once. The children of a node, and the
+iterations of a loop, are rendered concurrently, so the lookups of
+independent parts of a template overlap.
+
+This runs on the parse tree and needs Python 3.5 or later.
+"""
+
+import asyncio
+import functools
+import inspect
+
+from exc import TemplateContextError, TemplateError
+from context import LoopContext
+from utils import Constant, lookup, string_types
+
+
+class AsyncRenderer(object):
+    """
+    Renders a parse tree for a single Context, keeping the awaitables
+    found in it along the way.
+    """
+
+    def __init__(self):
+        # The task of each awaitable or coroutine function, by id, and
+        # of each call along a dotted name, by the id of the object and
+        # the name. What the id is of is kept along with the task, so
+        # that the id isn't reused.
+        self.tasks = {}
+
+    async def render(self, node, context):
+        method = getattr(self, 'render_' + node.__class__.__name__, None)
+        if method is None:
+            raise TemplateError(
+                'Cannot render node asynchronously: {0!r}'.format(node))
+        return await method(node, context)
+
+    async def render_children(self, children, context):
+        """
+        Render `children` concurrently, return their joined output.
+        """
+        coros = [self.render(child, context) for child in children]
+        if len(coros) == 1:
+            return await coros[0]
+        return ''.join(await self.gather(coros))
+
+    async def gather(self, coros):
+        """
+        Run `coros` concurrently, return their results. If one of them
+        fails, the others are cancelled.
+        """
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def cancel(self):
+        """
+        Cancel the tasks of the awaitables that are still pending, and
+        retrieve the errors of those that failed, which no one will.
+        """
+        for _, task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+    async def render_Root(self, node, context):
+        return await self.render_children(node.children, context)
+
+    async def render_HTML(self, node, context):
+        return str(node.render(context))
+
+    async def render_Variable(self, node, context):
+        if node.constant:
+            value = node.value
+        else:
+            value = await self.lookup(node.accessor, context)
+            if node.filters is not None:
+                value = node.filters(value)
+        if context.escape is not None:
+            value = context.escape(value)
+        if value is None:
+            return ''
+        value = str(value)
+        if context.meter is not None:
+            context.meter.write(len(value))
+        return value
+
+    async def render_Block(self, node, context):
+        return await self.render_children(node.children, context)
+
+    async def render_Cache(self, node, context):
+        key = None
+        if context.fragments is not None:
+            parts = []
+            for part in node.parts:
+                if not isinstance(part, string_types):
+                    part = str(await self.lookup(part, context))
+                parts.append(part)
+            key = ''.join(parts)
+            html = context.fragments.get(key)
+            if html is not None:
+                if context.meter is not None:
+                    context.meter.write(len(html))
+                return html
+        html = await self.render_children(node.children, context)
+        node.store(context, key, html)
+        return html
+
+    async def render_Include(self, node, context):
+        if node.linked:
+            return await self.render_children(node.children, context)
+        return await self.render(node.template(context).root, context)
+
+    async def render_Extends(self, node, context):
+        return ''
+
+    async def render_Else(self, node, context):
+        return ''
+
+    async def render_If(self, node, context):
+        condition = node.condition
+        if condition.constant:
+            test = condition.value
+        else:
+            left, right = await self.gather([
+                self.operand(condition.left, context),
+                self.operand(condition.right, context)])
+            if condition.op is None:
+                test = bool(right)
+            else:
+                test = condition.op(left, right)
+        if test:
+            return await self.render_children(node.children, context)
+        elif node.else_node is not None:
+            return await self.render_children(
+                node.else_node.children, context)
+        return ''
+
+    async def render_For(self, node, context):
+        if node._iter[0] == 'literal':
+            items = node._iter[1]
+        else:
+            items = await self.lookup(node._iter[1], context)
+        if not hasattr(items, '__len__') and context.meter is not None:
+            items = context.meter.take(items)
+        items = list(items)
+        if context.meter is not None:
+            context.meter.loop(len(items))
+        # Every iteration gets a scope of its own, since they are
+        # all rendered at the same time.
+        coros = []
+        for index, item in enumerate(items):
+            loop = LoopContext(len(items))
+            loop.index = index
+            scope = context.branch(
+                {'loop': loop, node._loop_var: item, 'index': index})
+            coros.append(self.render_children(node.children, scope))
+        return ''.join(await self.gather(coros))
+
+    async def operand(self, operand, context):
+        if isinstance(operand, Constant):
+            return operand.value
+        return await self.lookup(operand, context)
+
+    async def lookup(self, accessor, context):
+        """
+        The value of `accessor`, like `Accessor.__call__`, awaiting
+        every step of the path that needs it.
+        """
+        if not accessor.path:
+            try:
+                rv = context[accessor.head]
+            except KeyError:
+                raise TemplateContextError(accessor.name)
+            return await self.resolve(rv)
+        rv = await self.resolve(context.get(accessor.head, None))
+        if rv:
+            for name, kinds in zip(accessor.path, accessor._kinds):
+                rv = await self.resolve(await self.step(rv, name, kinds))
+        return rv
+
+    async def step(self, obj, name, kinds):
+        """
+        `obj.name` (or `obj[name]`), called if it is callable. A call
+        that gives an awaitable is made once per render for `obj` and
+        `name`, and the result awaited once, however often the render
+        looks it up.
+        """
+        key = (id(obj), name)
+        entry = self.tasks.get(key)
+        if entry is not None:
+            return await entry[1]
+        rv = lookup(obj, name, kinds)
+        if callable(rv):
+            rv = rv()
+        if not inspect.isawaitable(rv):
+            return rv
+        entry = self.tasks[key] = (obj, asyncio.ensure_future(rv))
+        return await entry[1]
+
+    async def resolve(self, value):
+        """
+        Await `value` if it needs to be, or call and await it if it is
+        a coroutine function. The result is shared by every lookup that
+        comes across the same `value` during the render.
+        """
+        if is_async(value):
+            make = value
+        elif inspect.isawaitable(value):
+            make = lambda: value
+        else:
+            return value
+        entry = self.tasks.get(id(value))
+        if entry is None:
+            entry = self.tasks[id(value)] = (
+                value, asyncio.ensure_future(make()))
+        return await entry[1]
+
+
+def is_async(func):
+    """
+    Whether `func` is a coroutine function: one defined with `async def`
+    (or with `asyncio.coroutine`), a partial of one, or an object whose
+    `__call__` is one.
+    """
+    if inspect.isclass(func):
+        return False
+    for func in (func, getattr(func, '__call__', None)):
+        while isinstance(func, functools.partial):
+            func = func.func
+        if inspect.iscoroutinefunction(func):
+            return True
+        # Generator based coroutines, up to Python 3.10.
+        if hasattr(asyncio, 'coroutine') and \
+                asyncio.iscoroutinefunction(func):
+            return True
+    return False
+
+
+async def render(root, context):
+    """
+    Render the parse tree `root` with `context`.
+    """
+    renderer = AsyncRenderer()
+    try:
+        return await renderer.render(root, context)
+    finally:
+        # Nothing is left running once the render is over, which
+        # matters when it failed halfway.
+        renderer.cancel()
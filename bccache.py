@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bytecode Cache.
+---------------
+Lexing, parsing and compiling every template again whenever a process
+starts adds up. A bytecode cache keeps the parse tree of a template,
+and the code object it compiles to, in a file on disk. A new process
+loads them from there instead.
+
+Entries are keyed by a hash of the template source, the options it
+was built with, the Tortoise version and the Python version, so a
+cache directory never hands out stale or incompatible code.
+
+Entries are pickled, and loading a pickle can run any code, so the
+cache only uses a directory that belongs to the current user and that
+no one else can write to. The default is a directory of its own for
+every user in the temporary directory, created with mode 0700.
+"""
+
+import getpass
+import hashlib
+import marshal
+import os
+import stat
+import sys
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from exc import TemplateError
+from tortoise import __version__
+
+
+def default_directory():
+    """
+    The cache directory of the current user, in the temporary directory.
+    """
+    if hasattr(os, 'getuid'):
+        user = str(os.getuid())
+    else:
+        user = getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), 'tortoise-cache-' + user)
+
+
+class FileSystemBytecodeCache(object):
+
+    def __init__(self, directory=None, pattern='__tortoise_{0}.cache'):
+        if directory is None:
+            directory = default_directory()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError:
+                # Someone else may have just made it.
+                if not os.path.isdir(directory):
+                    raise
+        self.directory = directory
+        self.pattern = pattern
+        if not self.is_safe():
+            raise TemplateError(
+                'Refusing to use bytecode cache directory "{0}": it must '
+                'belong to the current user and be writable by no one '
+                'else'.format(directory))
+
+    def is_safe(self):
+        """
+        Whether the cache directory belongs to the current user, and
+        no one else can write to it. Always true where there are no
+        user ids to check.
+        """
+        if not hasattr(os, 'getuid'):
+            return True
+        try:
+            st = os.stat(self.directory)
+        except OSError:
+            return False
+        return st.st_uid == os.getuid() and \
+            not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def get_key(self, source, *options):
+        """
+        The key of the entry for `source`, built with `options`.
+        """
+        key = hashlib.sha1()
+        for part in (__version__, sys.version, repr(options)):
+            key.update(part.encode('utf-8'))
+        key.update(b'\0')
+        key.update(source.encode('utf-8'))
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, self.pattern.format(key))
+
+    def load(self, key):
+        """
+        Return the (root, code, namespace) stored under `key`,
+        or None if there is no usable entry.
+        """
+        # The directory may have changed hands since the cache was set
+        # up, its entries can't be trusted then.
+        if not self.is_safe():
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                root, code, namespace = pickle.load(f)
+            if code is not None:
+                code = marshal.loads(code)
+        except Exception:
+            # Missing, half written or from an incompatible build,
+            # all the same to us: the template gets parsed again.
+            return None
+        return root, code, namespace
+
+    def dump(self, key, root, code=None, namespace=None):
+        """
+        Store the parse tree `root` under `key`, along with the code
+        it compiled to and the globals that code runs with.
+        """
+        if code is not None:
+            code = marshal.dumps(code)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((root, code, namespace), f,
+                            pickle.HIGHEST_PROTOCOL)
+            # Readers never see a partially written entry.
+            os.rename(tmp, self._path(key))
+        except Exception:
+            # Say a filter that doesn't pickle: no entry, that's all.
+            os.remove(tmp)
+
+    def clear(self):
+        prefix, suffix = self.pattern.split('{0}')
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix) and filename.endswith(suffix):
+                os.remove(os.path.join(self.directory, filename))
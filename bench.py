@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for Tortoise.
+------------------------
+Times lexing, parsing and rendering separately, on fixtures that stress
+different parts of the engine:
+
+    deep_nesting   For and If blocks nested 20 levels deep.
+    loop_10k       A For loop over 10,000 rows.
+    dotted         Long dotted lookups in a loop.
+    many_ifs       A template made of hundreds of If blocks.
+    static_parts   Loops over literals and constant Ifs, between text.
+
+For every benchmark it reports the best time per run, the throughput,
+and (on Python 3) the peak memory allocated during a run. With `-m`, it
+reports how much memory the parse tree of each fixture keeps instead.
+With `-j`, it renders a single template of each fixture from a pool of
+threads, checks that every render came out right, and reports the
+renders per second next to those of a single thread.
+
+    python bench.py                          # Run everything.
+    python bench.py -k render                # Only names containing 'render'.
+    python bench.py -o results.json          # Save the results...
+    python bench.py -b results.json          # ...and compare against them.
+    python bench.py -m                       # Memory per parsed template.
+    python bench.py -j 8                     # Renders from 8 threads.
+
+When comparing, benchmarks that got slower than the baseline by more
+than the tolerance are reported as regressions, and the exit status is 1.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+from multiprocessing.pool import ThreadPool
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import parser
+from lexer import Lexer
+from nodes import walk
+from tortoise import Tortoise, __version__
+
+# Aim for each timed repeat to take about this long, in seconds.
+TARGET_TIME = 0.2
+
+
+class Row(object):
+
+    def __init__(self, i):
+        self.id = i
+        self.name = 'row-{0}'.format(i)
+        self.user = {'profile': Profile(i)}
+        self.active = i % 3 != 0
+
+
+class Profile(object):
+
+    def __init__(self, i):
+        self.address = {'city': 'City {0}'.format(i % 100)}
+
+    def display(self):
+        return 'Profile'
+
+
+def deep_nesting(depth=20):
+    opening = ''.join('{% for x' + str(i) + ' in items %}\
+{% if x' + str(i) + ' %}<div>' for i in range(depth))
+    closing = '</div>{% endif %}{% endfor %}' * depth
+    return opening + '{{ name }}' + closing, {'items': [1], 'name': 'deep'}
+
+
+def loop_10k(rows=10000):
+    text = '<table>{% for row in rows %}<tr class="{{ loop.index }}">\
+<td>{{ row.id }}</td><td>{{ row.name }}</td>\
+<td>{% if row.active %}yes{% else %}no{% endif %}</td></tr>\
+{% endfor %}</table>'
+    return text, {'rows': [Row(i) for i in range(rows)]}
+
+
+def dotted(rows=2000):
+    text = '{% for row in rows %}{{ row.user.profile.address.city }}\
+ {{ row.user.profile.display }} {{ page.meta.title }}\n{% endfor %}'
+    ctx = {'rows': [Row(i) for i in range(rows)],
+           'page': {'meta': {'title': 'Title'}}}
+    return text, ctx
+
+
+def many_ifs(count=500):
+    text = '\n'.join('{% if n > ' + str(i) + ' %}<b>' + str(i) +
+                     '</b>{% else %}<i>{{ n }}</i>{% endif %}'
+                     for i in range(count))
+    return text, {'n': count // 2}
+
+
+def static_parts(count=100):
+    text = ''.join('<nav>{% for i in [1, 2, 3] %}<a href="/{{ i }}">\
+{{ loop.index }}</a>{% endfor %}</nav>{% if 1 %}<p>{{ "static" }}</p>\
+{% endif %}<b>{{ name }}</b>\n' for _ in range(count))
+    return text, {'name': 'static'}
+
+
+FIXTURES = [
+    ('deep_nesting', deep_nesting),
+    ('loop_10k', loop_10k),
+    ('dotted', dotted),
+    ('many_ifs', many_ifs),
+    ('static_parts', static_parts),
+]
+
+
+def benchmarks():
+    """
+    Generator of (name, function, size in bytes of what one run
+    processes) for every benchmark.
+    """
+    for name, fixture in FIXTURES:
+        text, ctx = fixture()
+        size = len(text)
+        yield ('lex/' + name, lambda text=text: list(Lexer(text)), size)
+        yield ('parse/' + name,
+               lambda text=text: parser.Parser(text).generate_parse_tree(),
+               size)
+        for mode, compiled in (('compiled', True), ('tree', False)):
+            template = Tortoise(text, compiled=compiled)
+            size = len(template.render(ctx))
+            yield ('render/{0}/{1}'.format(name, mode),
+                   lambda template=template, ctx=ctx: template.render(ctx),
+                   size)
+
+
+def measure(func, repeat):
+    """
+    Return the best time of a single call to `func`.
+    """
+    start = timeit.default_timer()
+    func()
+    elapsed = timeit.default_timer() - start
+    number = max(1, int(TARGET_TIME / max(elapsed, 1e-9)))
+    times = timeit.repeat(func, repeat=repeat, number=number)
+    return min(times) / number
+
+
+def peak_memory(func):
+    """
+    The peak memory allocated during a call to `func`, in bytes.
+    """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def retained_memory(func, samples=5):
+    """
+    The memory taken up by what `func` returns, in bytes. The first
+    calls also fill caches that stay around (compiled regexes, interned
+    strings), the least of `samples` calls leaves those out.
+    """
+    if tracemalloc is None:
+        return None
+    best = None
+    for _ in range(samples):
+        result = None
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            result = func()
+            memory = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            del result
+            tracemalloc.stop()
+        if best is None or memory < best:
+            best = memory
+    return best
+
+
+def tree_memory(pattern=None):
+    """
+    Print the memory the parse tree of each fixture keeps, along with
+    its number of nodes.
+    """
+    for name, fixture in FIXTURES:
+        if pattern and pattern not in name:
+            continue
+        text = fixture()[0]
+        parse = lambda text=text: parser.Parser(text).generate_parse_tree()
+        nodes = sum(1 for _ in walk(parse()))
+        memory = retained_memory(parse)
+        print('{0:<32} {1:>7} nodes {2:>10}'.format(
+            'memory/' + name, nodes,
+            '-' if memory is None else '{0:.1f} KB'.format(memory / 1024.0)))
+
+
+def threaded(pattern=None, threads=8, renders=200):
+    """
+    Render one shared template of each fixture `renders` times from a
+    pool of `threads` threads, print the renders per second along with
+    those of a single thread. Return the number of renders whose output
+    wasn't that of the same render done alone.
+    """
+    wrong = 0
+    print('{0:<32} {1:>11} {2:>11}'.format(
+        'benchmark', '1 thread', '{0} threads'.format(threads)))
+    pool = ThreadPool(threads)
+    try:
+        for name, fixture in FIXTURES:
+            if pattern and pattern not in name:
+                continue
+            text, ctx = fixture()
+            for mode, compiled in (('compiled', True), ('tree', False)):
+                template = Tortoise(text, compiled=compiled)
+                expected = template.render(ctx)
+                render = lambda _: template.render(ctx)
+                start = timeit.default_timer()
+                for i in range(renders):
+                    render(i)
+                single = renders / (timeit.default_timer() - start)
+                start = timeit.default_timer()
+                results = pool.map(render, range(renders))
+                pooled = renders / (timeit.default_timer() - start)
+                errors = sum(1 for html in results if html != expected)
+                wrong += errors
+                print('{0:<32} {1:>9.1f}/s {2:>9.1f}/s {3:>6} wrong'.format(
+                    'threads/{0}/{1}'.format(name, mode), single, pooled,
+                    errors))
+    finally:
+        pool.close()
+        pool.join()
+    return wrong
+
+
+def run(pattern=None, repeat=5):
+    results = {}
+    for name, func, size in benchmarks():
+        if pattern and pattern not in name:
+            continue
+        seconds = measure(func, repeat)
+        results[name] = {
+            'seconds': seconds,
+            'ops_per_sec': 1.0 / seconds,
+            'mb_per_sec': size / seconds / 1e6,
+            'peak_memory': peak_memory(func),
+        }
+        report(name, results[name])
+    return results
+
+
+def report(name, result):
+    memory = result['peak_memory']
+    line = '{0:<32} {1:>10.3f} ms {2:>9.1f} MB/s {3:>10}'.format(
+        name, result['seconds'] * 1e3, result['mb_per_sec'],
+        '-' if memory is None else '{0:.1f} KB'.format(memory / 1024.0))
+    print(line)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how `results` compare to `baseline`, return the names of
+    the benchmarks that regressed.
+    """
+    regressions = []
+    print('\n{0:<32} {1:>10} {2:>10} {3:>8}'.format(
+        'benchmark', 'baseline', 'now', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        now = results[name]['seconds']
+        change = now / before - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{0:<32} {1:>7.3f} ms {2:>7.3f} ms {3:>+7.1%}{4}'.format(
+            name, before * 1e3, now * 1e3, change, flag))
+    return regressions
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        description='Benchmark lexing, parsing and rendering.')
+    argparser.add_argument('-k', dest='pattern',
+                           help='only run benchmarks whose name contains this')
+    argparser.add_argument('-r', '--repeat', type=int, default=5,
+                           help='number of timed repeats (best one counts)')
+    argparser.add_argument('-o', '--output',
+                           help='write the results to this JSON file')
+    argparser.add_argument('-b', '--baseline',
+                           help='compare against the results in this file')
+    argparser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                           help='slowdown that counts as a regression')
+    argparser.add_argument('-m', '--memory', action='store_true',
+                           help='report the memory of parse trees instead')
+    argparser.add_argument('-j', '--threads', type=int,
+                           help='render from this many threads instead')
+    argparser.add_argument('-n', '--renders', type=int, default=200,
+                           help='number of renders per fixture, with -j')
+    args = argparser.parse_args(argv)
+
+    if args.memory:
+        tree_memory(args.pattern)
+        return 0
+    if args.threads:
+        if threaded(args.pattern, args.threads, args.renders):
+            return 1
+        return 0
+
+    results = run(args.pattern, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'tortoise': __version__,
+                'python': platform.python_version(),
+                'time': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Render Budgets.
+---------------
+A template rendered with a Budget stops with TemplateBudgetExceeded as
+soon as a single render goes over one of its limits, instead of tying
+up the worker it runs on:
+
+    budget = Budget(iterations=100000, output=10 * 1024 * 1024, seconds=1)
+    template = Tortoise(text, budget=budget)
+
+:iterations: The number of For loop iterations, all loops together.
+:output: The number of characters of output.
+:seconds: The wall time of the render.
+
+Loops are charged for all of their items when they start, before any
+of them is rendered. The items of a generator (or anything else
+without a length) are charged as they are taken. Output and time are
+checked on every iteration.
+The checks are compiled into the render function of templates that
+have a Budget, and left out of every other one.
+"""
+
+from timeit import default_timer
+
+from exc import TemplateBudgetExceeded
+
+INFINITY = float('inf')
+
+
+class Budget(object):
+    """
+    The limits of a render, None for no limit.
+    """
+
+    def __init__(self, iterations=None, output=None, seconds=None,
+                 timer=default_timer):
+        self.iterations = iterations
+        self.output = output
+        self.seconds = seconds
+        self.timer = timer
+
+    def start(self):
+        """
+        Return the Meter for a new render.
+        """
+        return Meter(self)
+
+    def __repr__(self):
+        return '<Budget iterations={0} output={1} seconds={2}>'.format(
+            self.iterations, self.output, self.seconds)
+
+
+class Meter(object):
+    """
+    What is left of a Budget during a single render.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.timer = budget.timer
+        self.iterations = budget.iterations
+        self.max_output = INFINITY if budget.output is None \
+            else budget.output
+        self.deadline = INFINITY if budget.seconds is None \
+            else self.timer() + budget.seconds
+        # The output so far, for the tree renderer. Compiled templates
+        # keep count in a local of their own.
+        self.written = 0
+
+    def loop(self, count):
+        """
+        Charge the render for a loop over `count` items.
+        """
+        if self.iterations is not None:
+            self.iterations -= count
+            if self.iterations < 0:
+                raise TemplateBudgetExceeded(
+                    'iterations', self.budget.iterations)
+        self.check_time()
+
+    def take(self, items):
+        """
+        Return a list of the items of the iterable `items`, one without
+        a length, like a generator. Taking them stops as soon as there
+        are more than the iterations left, or time runs out.
+        """
+        taken = []
+        for item in items:
+            taken.append(item)
+            if self.iterations is not None and \
+                    len(taken) > self.iterations:
+                raise TemplateBudgetExceeded(
+                    'iterations', self.budget.iterations)
+            self.check_time()
+        return taken
+
+    def write(self, size):
+        """
+        Charge the render for `size` characters of output.
+        """
+        self.written += size
+        if self.written > self.max_output:
+            raise TemplateBudgetExceeded('output', self.budget.output)
+
+    def check(self, written):
+        """
+        Check that `written` characters of output and the time spent
+        so far are within the budget.
+        """
+        if written > self.max_output:
+            raise TemplateBudgetExceeded('output', self.budget.output)
+        self.check_time()
+
+    def check_time(self):
+        if self.timer() > self.deadline:
+            raise TemplateBudgetExceeded('seconds', self.budget.seconds)
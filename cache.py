@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Caches used by Tortoise.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from timeit import default_timer
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that holds at most `capacity` items,
+    the least recently used item is dropped to make room for new ones.
+    It is safe to share between threads.
+
+    Items can also expire: `ttl` is the number of seconds an item is
+    kept for by default, None to keep it until it is dropped. `timer`
+    tells the time, in seconds.
+    """
+
+    def __init__(self, capacity=100, ttl=None, timer=default_timer):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.timer = timer
+        # The items, as (value, time they expire at or None).
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.timer():
+                return default
+            # Move the item back to the most recently used end.
+            self._data[key] = value, expires
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store `value` under `key`, for `ttl` seconds if given.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self.timer() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, expires
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def items(self):
+        """
+        A list of the (key, value) pairs, without counting as a use.
+        """
+        with self._lock:
+            return [(key, value)
+                    for key, (value, _) in self._data.items()]
+
+    def __getitem__(self, key):
+        rv = self.get(key, _missing)
+        if rv is _missing:
+            raise KeyError(key)
+        return rv
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+        return item is not None and \
+            (item[1] is None or item[1] > self.timer())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<LRUCache {0}/{1}>'.format(len(self), self.capacity)
+
+
+_missing = object()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Template Compiler for Tortoise.
+-------------------------------
+Rendering a parse tree means walking every Node on every render,
+dispatching to each Node's render method and building closures
+along the way.
+
+The compiler walks the tree just once instead, and generates the
+source of a single Python function that does the same work with
+plain Python control flow: HTML becomes a constant, an If becomes
+an `if` statement, a For becomes a `for` loop. Anything that needs
+the Node itself (resolving the iterable of a loop, testing a
+condition) is looked up from the function's globals, where the
+Node objects are bound under generated names.
+
+The tree renderer stays around as the reference implementation,
+both of them must produce identical output.
+"""
+
+from timeit import default_timer as timer
+
+from exc import TemplateError
+import markup
+
+
+class CodeGenerator(object):
+    """
+    Generate the source of the functions for a parse tree:
+    `render(ctx)`, which returns the whole output, and `stream(ctx)`,
+    a generator of the output in chunks. Both run the same code, they
+    only differ in what they do with each piece of output.
+    """
+
+    indent_with = '    '
+
+    # The nodes that get timed in profiled templates.
+    profiled = ('Variable', 'For', 'If')
+
+    def __init__(self, root, autoescape=False, name='<template>',
+                 profile=False, budget=False):
+        self.root = root
+        self.autoescape = autoescape
+        self.name = name
+        self.profile = profile
+        # Check the budget of the render (see the budget module)?
+        self.budget = budget
+        self.lines = []
+        self.namespace = {
+            '_str': str,
+            '_timer': timer,
+        }
+        self._indent = 0
+        self._names = 0
+        self._stream = False
+        # The list `_w` appends to, when not streaming.
+        self._buffer = '_buf'
+        # Names that are bound to a local of the generated code,
+        # like the variables of the loops we are in.
+        self.scope = {}
+
+    def generate(self):
+        self.writeline('def render(ctx):')
+        self.indent()
+        self.writeline('_buf = []')
+        self.writeline('_w = _buf.append')
+        self.write_prologue()
+        self.visit(self.root)
+        self.write_epilogue()
+        self.writeline("return ''.join(_buf)")
+        self.outdent()
+
+        self._stream = True
+        self.writeline('def stream(ctx):')
+        self.indent()
+        self.write_prologue()
+        self.visit(self.root)
+        self.write_epilogue()
+        # Makes this a generator even if the template renders nothing.
+        self.writeline('return')
+        self.writeline('yield')
+        self.outdent()
+        return '\n'.join(self.lines) + '\n'
+
+    def write_prologue(self):
+        if self.autoescape:
+            self.writeline('_e = ctx.escape')
+        if self.budget:
+            # _out counts the output.
+            self.writeline('_m = ctx.meter')
+            self.writeline('_out = 0')
+            self.writeline('_mo, _md = _m.max_output, _m.deadline')
+
+    def write_epilogue(self):
+        if self.budget:
+            self.writeline('if _out > _mo:')
+            self.indent()
+            self.writeline('_m.check(_out)')
+            self.outdent()
+
+    def emit(self, expr):
+        """
+        Output the value of `expr`.
+        """
+        if self.budget:
+            self.writeline('_s = ' + expr)
+            self.writeline('_out += len(_s)')
+            expr = '_s'
+        if self._stream:
+            self.writeline('yield ' + expr)
+        else:
+            self.writeline('_w({0})'.format(expr))
+
+    def writeline(self, line):
+        self.lines.append(self.indent_with * self._indent + line)
+
+    def indent(self):
+        self._indent += 1
+
+    def outdent(self):
+        self._indent -= 1
+
+    def bind(self, value, prefix='_n'):
+        """
+        Make `value` available to the generated code, return its name.
+        """
+        name = '{0}{1}'.format(prefix, self._names)
+        self._names += 1
+        self.namespace[name] = value
+        return name
+
+    def visit(self, node):
+        method = getattr(self, 'visit_' + node.__class__.__name__, None)
+        if method is None:
+            raise TemplateError(
+                'Cannot compile node: {0!r}'.format(node))
+        if self.profile and node.__class__.__name__ in self.profiled:
+            self.visit_profiled(node, method)
+        else:
+            method(node)
+
+    def visit_profiled(self, node, method):
+        """
+        Visit `node` with `method`, timing the code it generates.
+        `_profiler` is provided when the code is loaded.
+        """
+        token = node.token
+        # Nodes of the templates this one extends or includes are
+        # reported where they were written.
+        name = self.name if token.template is None else token.template
+        key = self.bind((name, token.line_no, token.col_no, token.value),
+                        '_k')
+        self.writeline('{0}_t = _timer()'.format(key))
+        method(node)
+        self.writeline('_profiler.record({0}, _timer() - {0}_t)'.format(key))
+
+    def visit_children(self, children):
+        for child in children:
+            self.visit(child)
+
+    def visit_block(self, children):
+        """
+        Visit the children that make up the body of a compound
+        statement, which must not be left empty.
+        """
+        self.indent()
+        start = len(self.lines)
+        self.visit_children(children)
+        if len(self.lines) == start:
+            self.writeline('pass')
+        self.outdent()
+
+    def visit_Root(self, node):
+        self.visit_children(node.children)
+
+    def visit_HTML(self, node):
+        self.emit(self.bind(str(node.token), '_c'))
+
+    def visit_Variable(self, node):
+        if node.constant:
+            if node.value is not None:
+                value = node.value
+                if self.autoescape:
+                    value = markup.escape(value)
+                self.emit(self.bind(str(value), '_c'))
+            return
+        expr = self.lookup(node.accessor)
+        if node.filters is not None:
+            expr = self.apply_filters(expr, node.filters)
+        if self.autoescape:
+            self.emit('_e({0})'.format(expr))
+        else:
+            self.writeline('_v = ' + expr)
+            self.emit("'' if _v is None else _str(_v)")
+
+    def apply_filters(self, expr, chain):
+        """
+        Return an expression that passes the value of `expr` through
+        the filters of `chain`, as nested calls.
+        """
+        for func, args in chain.funcs:
+            params = [expr] + [self.bind(arg, '_c') for arg in args]
+            expr = '{0}({1})'.format(self.bind(func, '_f'), ', '.join(params))
+        return expr
+
+    def visit_Block(self, node):
+        self.visit_children(node.children)
+
+    def visit_Cache(self, node):
+        name = self.bind(node)
+        key, html = name + '_k', name + '_h'
+        self.writeline('{0}, {1} = {2}.lookup(ctx)'.format(key, html, name))
+        self.writeline('if {0} is None:'.format(html))
+        self.indent()
+        if self._stream:
+            # The fragment is rendered as a whole, to be cached.
+            buf = name + '_b'
+            self.writeline('{0} = []'.format(buf))
+            self.writeline('_w = {0}.append'.format(buf))
+            self._stream, self._buffer = False, buf
+            self.visit_children(node.children)
+            self._stream, self._buffer = True, '_buf'
+            self.writeline("{0} = ''.join({1})".format(html, buf))
+            self.writeline('{0}.store(ctx, {1}, {2})'.format(name, key, html))
+            self.outdent()
+            if self.budget:
+                # What was rendered has been counted already.
+                self.writeline('else:')
+                self.indent()
+                self.writeline('_out += len({0})'.format(html))
+                self.outdent()
+            self.writeline('yield ' + html)
+        else:
+            # The fragment goes to the output as it is rendered, it is
+            # picked out of the buffer afterwards.
+            mark = name + '_m'
+            self.writeline('{0} = len({1})'.format(mark, self._buffer))
+            self.visit_children(node.children)
+            self.writeline("{0} = ''.join({1}[{2}:])".format(
+                html, self._buffer, mark))
+            self.writeline('{0}.store(ctx, {1}, {2})'.format(name, key, html))
+            self.outdent()
+            self.writeline('else:')
+            self.indent()
+            self.emit(html)
+            self.outdent()
+
+    def visit_Include(self, node):
+        if node.linked:
+            # The included tree is compiled into this template.
+            self.visit_children(node.children)
+        elif self._stream:
+            self.writeline('for _x in {0}.stream(ctx):'.format(
+                self.bind(node)))
+            self.indent()
+            self.emit('_x')
+            self.outdent()
+        else:
+            self.emit('{0}.render(ctx)'.format(self.bind(node)))
+
+    def visit_Extends(self, node):
+        # Nothing to render, the tree has been flattened already.
+        pass
+
+    def visit_Else(self, node):
+        # An Else renders nothing by itself, the If it belongs
+        # to takes care of its children.
+        pass
+
+    def visit_If(self, node):
+        condition, else_node = node.condition, node.else_node
+        if condition.constant:
+            # No need to test at render time.
+            if condition.value:
+                self.visit_children(node.children)
+            elif else_node is not None:
+                self.visit_children(else_node.children)
+            return
+        self.writeline('if {0}(ctx):'.format(self.bind(condition, '_t')))
+        self.visit_block(node.children)
+        if else_node is not None:
+            self.writeline('else:')
+            self.visit_block(else_node.children)
+
+    def visit_For(self, node):
+        name = self.bind(node)
+        items, loop, frame = name + '_s', name + '_l', name + '_f'
+        index, item = name + '_i', name + '_x'
+        self.writeline('{0}, {1} = {2}.start(ctx)'.format(items, loop, name))
+        if self.budget:
+            self.writeline('_m.loop({0}.length)'.format(loop))
+        self.writeline("{0} = ctx.push({{'loop': {1}}})".format(frame, loop))
+        self.writeline('for {0}, {1} in enumerate({2}):'.format(
+            index, item, items))
+        self.indent()
+        if self.budget:
+            self.writeline('if _out > _mo or _timer() > _md:')
+            self.indent()
+            self.writeline('_m.check(_out)')
+            self.outdent()
+        self.writeline('{0}.index = {1}'.format(loop, index))
+        self.writeline('{0}[{1}] = {2}'.format(
+            frame, self.bind(node._loop_var, '_c'), item))
+        self.writeline("{0}['index'] = {1}".format(frame, index))
+        self.outdent()
+        # Inside the loop, its variables are read from the locals.
+        outer = self.scope
+        self.scope = dict(outer)
+        # In the same order as the frame the tree renderer sets them in,
+        # so that the same one wins when they share a name.
+        self.scope['loop'] = loop
+        self.scope[node._loop_var] = item
+        self.scope['index'] = index
+        self.visit_block(node.children)
+        self.scope = outer
+        self.writeline('ctx.pop()')
+
+    def lookup(self, accessor):
+        """
+        Return an expression for the value of `accessor`.
+        """
+        local = self.scope.get(accessor.head)
+        if local is None:
+            return '{0}(ctx)'.format(self.bind(accessor, '_a'))
+        elif accessor.path:
+            return '{0}.walk({1})'.format(self.bind(accessor, '_a'), local)
+        return local
+
+
+def generate(root, autoescape=False, name='<template>', profile=False,
+             budget=False):
+    """
+    Return the generated source and the globals it has to run with.
+    """
+    generator = CodeGenerator(root, autoescape, name, profile, budget)
+    return generator.generate(), generator.namespace
+
+
+def compile_tree(root, name='<template>', autoescape=False, profile=False,
+                 budget=False):
+    """
+    Compile a parse tree, return the code object along with the
+    globals it has to run with.
+    """
+    source, namespace = generate(root, autoescape, name, profile, budget)
+    return compile(source, name, 'exec'), namespace
+
+
+def load(code, namespace, **extra):
+    """
+    Run the code of a compiled template, return its `render(ctx)`
+    and `stream(ctx)` functions. `extra` are globals that don't belong
+    in the namespace that gets cached, like the Profiler.
+    """
+    namespace = dict(namespace, **extra)
+    exec(code, namespace)
+    return namespace['render'], namespace['stream']
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Render Context.
+---------------
+The context a template is rendered with is never written to. Each
+render wraps it in a Context, a stack of frames that names are looked
+up in from the top down. A scope such as a For loop pushes its own
+frame for the names it defines, and pops it once it is done, so that
+nested loops don't overwrite each other and nothing leaks out of a
+render into the caller's dict.
+
+A value that is costly to work out, and that not every template (or
+every branch of one) needs, can be passed as a `Lazy`:
+
+    template.render({'stats': Lazy(load_stats)})
+
+`load_stats()` is only called once the render looks `stats` up, and
+just once per render, however often it is looked up.
+"""
+
+
+class Lazy(object):
+    """
+    A context value that is worked out by calling `func()` when it is
+    first looked up in a render.
+    """
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __repr__(self):
+        return '<Lazy {0!r}>'.format(self.func)
+
+
+class Context(object):
+    """
+    :data: The dict the template is rendered with.
+    :escape: With autoescape on, the function that escapes the value
+             of each Variable for this render.
+    :fragments: The cache that `{% cache %}` blocks keep their output
+                in, None to render them every time.
+    :env: The Environment that `{% include %}`s with a name from the
+          context load their template from.
+    :meter: The budget.Meter of the render, if it has a Budget.
+    """
+
+    def __init__(self, data=None, escape=None, fragments=None, env=None,
+                 meter=None):
+        self.frames = [{} if data is None else data]
+        self.escape = escape
+        self.fragments = fragments
+        self.env = env
+        self.meter = meter
+        # The values of the Lazy values looked up so far, by id.
+        self.lazy = {}
+
+    def push(self, frame=None):
+        """
+        Enter a new scope, return its frame.
+        """
+        if frame is None:
+            frame = {}
+        self.frames.append(frame)
+        return frame
+
+    def pop(self):
+        """
+        Leave the innermost scope.
+        """
+        return self.frames.pop()
+
+    def branch(self, frame):
+        """
+        Return a new Context that sees the scopes of this one, with
+        `frame` on top. Scopes that are rendered at the same time, like
+        the iterations of a loop rendered asynchronously, each get one.
+        """
+        context = Context(None, self.escape, self.fragments, self.env,
+                          self.meter)
+        context.frames = self.frames + [frame]
+        context.lazy = self.lazy
+        return context
+
+    def __getitem__(self, key):
+        for frame in reversed(self.frames):
+            if key in frame:
+                value = frame[key]
+                if type(value) is Lazy:
+                    return self.force(value)
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        for frame in reversed(self.frames):
+            if key in frame:
+                value = frame[key]
+                if type(value) is Lazy:
+                    return self.force(value)
+                return value
+        return default
+
+    def peek(self, key, default=None):
+        """
+        The value of `key` as the frames have it, without working out
+        Lazy values.
+        """
+        for frame in reversed(self.frames):
+            if key in frame:
+                return frame[key]
+        return default
+
+    def force(self, value):
+        """
+        The value of the Lazy `value` for this render.
+        """
+        try:
+            return self.lazy[id(value)][1]
+        except KeyError:
+            result = value.func()
+            # The Lazy is kept along, so that its id isn't reused.
+            self.lazy[id(value)] = value, result
+            return result
+
+    def __contains__(self, key):
+        for frame in self.frames:
+            if key in frame:
+                return True
+        return False
+
+    def __repr__(self):
+        return '<Context {0!r}>'.format(self.frames)
+
+
+class LoopContext(object):
+    """
+    The `loop` variable inside a For loop.
+
+    :index: 0-based index of the current item.
+    :first: True for the first item.
+    :last: True for the last item.
+    :length: The number of items.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.index = -1
+
+    @property
+    def first(self):
+        return self.index == 0
+
+    @property
+    def last(self):
+        return self.index == self.length - 1
+
+    def __repr__(self):
+        return '<LoopContext {0}/{1}>'.format(self.index, self.length)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The Environment ties a Loader to a cache of parsed templates.
+
+    env = Environment(FileSystemLoader('templates'))
+    env.get_template('index.html').render({'name': 'Manish'})
+
+Templates are parsed (and compiled) the first time they are asked for.
+After that they come out of a bounded LRU cache, and are only parsed
+again once their file changes on disk, or the file of a template they
+depend on (the one they extend, the ones they include) does. Templates
+that depend on nothing that changed are left alone.
+
+A template is never changed once it is loaded: reloading builds a new
+one and swaps it into the cache, so renders that are under way finish
+with the template they started with.
+"""
+
+import threading
+
+from cache import LRUCache
+from exc import TemplateError
+from tortoise import Tortoise, FRAGMENT_CACHE_SIZE
+
+
+class Environment(object):
+
+    def __init__(self, loader, cache_size=50, auto_reload=True,
+                 compiled=None, bytecode_cache=None, autoescape=False,
+                 profiler=None, collapse_whitespace=False,
+                 fragment_cache=None, context_processors=None, budget=None):
+        self.loader = loader
+        self.cache = LRUCache(cache_size)
+        # Check the files of cached templates for changes?
+        self.auto_reload = auto_reload
+        self.compiled = compiled
+        # Parsed templates on disk, shared between processes.
+        self.bytecode_cache = bytecode_cache
+        self.autoescape = autoescape
+        # Profile every template rendered through this Environment?
+        self.profiler = profiler
+        self.collapse_whitespace = collapse_whitespace
+        # The cache {% cache %} blocks share, in every template.
+        if fragment_cache is None:
+            fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+        self.fragment_cache = fragment_cache
+        # Functions called for every render, each returning a dict of
+        # values for the templates. Values are Lazy where they cost.
+        self.context_processors = list(context_processors or ())
+        # The limits of every render, see the budget module.
+        self.budget = budget
+        # Held while templates are loaded, so that each one is only
+        # loaded once. Loading a template can load the ones it depends
+        # on, hence the RLock.
+        self._lock = threading.RLock()
+        # The templates being loaded, to catch includes that go round.
+        self._loading = set()
+        # The error of each template that failed to reload, by name.
+        # It keeps the template it had until it loads again.
+        self.errors = {}
+
+    def get_template(self, name):
+        """
+        Return the template called `name`, from the cache if it is
+        still up to date.
+        """
+        template = self._get_cached(name)
+        if template is not None:
+            return template
+        with self._lock:
+            # It may have been loaded while we waited for the lock.
+            template = self._get_cached(name)
+            if template is None:
+                template = self._load_template(name)
+            return template
+
+    def _get_cached(self, name):
+        template = self.cache.get(name)
+        if template is not None and \
+                (not self.auto_reload or self.is_up_to_date(template)):
+            return template
+
+    def _load_template(self, name):
+        if name in self._loading:
+            raise TemplateError(
+                'Template "{0}" depends on itself'.format(name))
+        source, path, state = self.loader.get_source(name)
+        self._loading.add(name)
+        try:
+            template = self.from_string(source, name)
+        finally:
+            self._loading.discard(name)
+        files = [(path, state)]
+        for dependency in template.dependencies():
+            files.extend(dependency.files)
+        template.files = tuple(files)
+        self.cache[name] = template
+        return template
+
+    def is_up_to_date(self, template):
+        """
+        Whether none of the files `template` was built from changed.
+        """
+        get_state = self.loader.get_state
+        return all(get_state(path) == state for path, state in template.files)
+
+    def reload(self):
+        """
+        Load the cached templates whose files changed again, along with
+        the ones that depend on them, and return the names of those that
+        were reloaded. A template that fails to load, because of a
+        syntax error or a file that is gone, keeps being served as it
+        was, its error is kept in `errors`, and it is tried again on
+        the next reload.
+        """
+        reloaded = []
+        with self._lock:
+            stale = [name for name, template in self.cache.items()
+                     if not self.is_up_to_date(template)]
+            for name in stale:
+                # Loading a template may have reloaded another stale one.
+                template = self.cache.get(name)
+                if template is None or not self.is_up_to_date(template):
+                    try:
+                        self._load_template(name)
+                    except TemplateError as e:
+                        self.errors[name] = e
+                        continue
+                self.errors.pop(name, None)
+                reloaded.append(name)
+        return reloaded
+
+    def watch(self, interval=1.0):
+        """
+        Call `reload` every `interval` seconds from a daemon thread.
+        Return a threading.Event that stops the thread once it is set.
+        """
+        stop = threading.Event()
+
+        def poll():
+            while not stop.wait(interval):
+                try:
+                    self.reload()
+                except Exception:
+                    # Whatever went wrong may be fixed by the next try,
+                    # the thread must live on to see it.
+                    pass
+
+        thread = threading.Thread(target=poll, name='tortoise-reload')
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    def from_string(self, text, name=None):
+        """
+        Create a template from `text`, bypassing the loader and the cache.
+        """
+        return Tortoise(text, compiled=self.compiled, name=name, env=self,
+                        bytecode_cache=self.bytecode_cache,
+                        autoescape=self.autoescape, profiler=self.profiler,
+                        collapse_whitespace=self.collapse_whitespace,
+                        fragment_cache=self.fragment_cache,
+                        context_processors=self.context_processors,
+                        budget=self.budget)
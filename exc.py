@@ -23,3 +23,27 @@ class TemplateSyntaxError(TemplateError):
 
     def __str__(self):
         return '%s' % self.error_syntax
+
+
+class TemplateNotFound(TemplateError):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return 'Template not found: "%s"' % self.name
+
+
+class TemplateBudgetExceeded(TemplateError):
+    """
+    A render went over one of the limits of its Budget: `budget` is
+    'iterations', 'output' or 'seconds', and `limit` the limit.
+    """
+
+    def __init__(self, budget, limit):
+        self.budget = budget
+        self.limit = limit
+
+    def __str__(self):
+        return 'Render budget exceeded: more than %s %s' % (
+            self.limit, self.budget)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Filters.
+--------
+A Variable can pass its value through a pipeline of filters:
+
+    {{ name|lower|capitalize }}
+    {{ description|truncate(20, "...") }}
+
+Filters are plain functions that take the value as their first argument,
+and the arguments given in the template after it. Arguments have to
+be literals. New filters are added to the registry with `register`:
+
+    @register('shout')
+    def shout(value):
+        return str(value).upper() + '!'
+
+Filters are expected to be pure functions of their arguments, since a
+filter applied to a literal is worked out once, when the template is
+parsed. The filters of a Variable are fused into a single function, so
+rendering makes just one call no matter how long the pipeline is.
+"""
+
+import ast
+import re
+
+from exc import TemplateSyntaxError
+from markup import Markup, escape
+
+# The registry of filters, by name.
+FILTERS = {}
+
+_RE_FILTER = re.compile(r'^(\w+)\s*(?:\((.*)\))?$', re.S)
+
+
+def register(name):
+    """
+    Decorator that adds a filter function to the registry as `name`.
+    """
+    def decorator(func):
+        FILTERS[name] = func
+        return func
+    return decorator
+
+
+def split_pipes(text):
+    """
+    Split `text` on the '|'s that are not inside of quotes or parentheses.
+    """
+    parts, start, quote, depth = [], 0, None, 0
+    escaped = False
+    for i, char in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+def parse(text):
+    """
+    Split the content of a Variable into the expression whose value
+    gets filtered, and the FilterChain to filter it with, None if
+    there are no filters.
+    """
+    parts = split_pipes(text)
+    if len(parts) == 1:
+        return text, None
+    steps = []
+    for part in parts[1:]:
+        match = _RE_FILTER.match(part)
+        if match is None:
+            raise TemplateSyntaxError('Invalid filter: {0}'.format(part))
+        name, args = match.groups()
+        if name not in FILTERS:
+            raise TemplateSyntaxError('Unknown filter: {0}'.format(name))
+        steps.append((name, parse_args(args)))
+    return parts[0], FilterChain(steps)
+
+
+def parse_args(args):
+    """
+    The arguments of a filter, as a tuple of literals.
+    """
+    if args is None or not args.strip():
+        return ()
+    try:
+        return ast.literal_eval('({0},)'.format(args))
+    except (ValueError, SyntaxError):
+        raise TemplateSyntaxError(
+            'Filter arguments must be literals: {0}'.format(args))
+
+
+class FilterChain(object):
+    """
+    A pipeline of filters, fused into a single function of the value.
+
+    :steps: A list of (filter name, arguments) pairs.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.funcs = [(FILTERS[name], args) for name, args in steps]
+        self.func = self.fuse()
+
+    def fuse(self):
+        """
+        Build a function which applies all the filters in one go:
+        `lambda value: f1(f0(value, a0), a1)`.
+        """
+        namespace = {}
+        expr = 'value'
+        for i, (func, args) in enumerate(self.funcs):
+            expr = self.call(expr, func, args, namespace, '_f{0}'.format(i))
+        return eval('lambda value: ' + expr, namespace)
+
+    def call(self, expr, func, args, namespace, name):
+        """
+        Return the expression calling `func` with `expr` as its first
+        argument. `func` and `args` are added to `namespace`.
+        """
+        namespace[name] = func
+        params = [expr]
+        for i, arg in enumerate(args):
+            params.append('{0}_{1}'.format(name, i))
+            namespace[params[-1]] = arg
+        return '{0}({1})'.format(name, ', '.join(params))
+
+    def __call__(self, value):
+        return self.func(value)
+
+    def __getstate__(self):
+        # Functions don't pickle, filters are looked up again by name.
+        return self.steps
+
+    def __setstate__(self, steps):
+        self.__init__(steps)
+
+    def __repr__(self):
+        return '<FilterChain {0}>'.format(
+            '|'.join(name for name, _ in self.steps))
+
+
+@register('upper')
+def upper(value):
+    return str(value).upper()
+
+
+@register('lower')
+def lower(value):
+    return str(value).lower()
+
+
+@register('title')
+def title(value):
+    return str(value).title()
+
+
+@register('capitalize')
+def capitalize(value):
+    return str(value).capitalize()
+
+
+@register('trim')
+def trim(value):
+    return str(value).strip()
+
+
+@register('replace')
+def replace(value, old, new):
+    return str(value).replace(old, new)
+
+
+@register('truncate')
+def truncate(value, length=255, end='...'):
+    value = str(value)
+    if len(value) <= length:
+        return value
+    return value[:max(length - len(end), 0)] + end
+
+
+@register('default')
+def default(value, default_value=''):
+    return default_value if value is None or value == '' else value
+
+
+@register('length')
+def length(value):
+    return len(value)
+
+
+@register('join')
+def join(value, separator=''):
+    return separator.join(str(item) for item in value)
+
+
+@register('first')
+def first(value):
+    return next(iter(value), None)
+
+
+@register('last')
+def last(value):
+    return list(value)[-1] if value else None
+
+
+@register('round')
+def round_(value, precision=0):
+    return round(value, precision)
+
+
+@register('safe')
+def safe(value):
+    return Markup(value)
+
+
+register('escape')(escape)
+register('e')(escape)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental Rendering.
+----------------------
+A RenderSession renders a template over and over, for contexts that
+only differ in a few values from one render to the next, like those of
+a dashboard that is refreshed every few seconds:
+
+    session = template.session()
+    html = session.render(ctx)
+    ...
+    html = session.render(new_ctx)
+
+The template is split into parts, the nodes at the top of its tree
+(going into Blocks and included templates). Each part knows the names
+it looks up in the context, and the session keeps its output along
+with the values that those names had. A part is only rendered again
+once one of them changes: is replaced by a value that isn't equal to
+it. A value that is changed in place, rather than replaced, looks the
+same to the session. Lazy values are compared as they are, not worked
+out. Parts that include a template by a name from the context, which
+could look up anything, are rendered every time.
+
+`session.changes(new_ctx)` renders just the same, and returns the
+parts whose output changed, for clients that patch a page instead of
+replacing it.
+
+A session keeps the state of one stream of renders, and is not meant
+to be shared between threads.
+"""
+
+import compiler
+from nodes import Root, Block, Include, find_names, walk
+
+# Stands for the value of a name that isn't in the context.
+_missing = object()
+
+
+class Part(object):
+    """
+    A node at the top of the tree of a template, with what it takes to
+    render it by itself.
+
+    :names: The names it looks up, None if it could look up anything.
+    """
+
+    def __init__(self, node, render):
+        self.node = node
+        self.render = render
+        if any(isinstance(child, Include) and not child.linked
+               for child in walk(node)):
+            self.names = None
+        else:
+            self.names = frozenset(find_names(node))
+
+
+class RenderSession(object):
+    """
+    Renders `template` again and again, redoing only the parts whose
+    names changed value since the previous render.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.parts = [Part(node, self.compile(node))
+                      for node in split(template.root)]
+        self.names = set()
+        for part in self.parts:
+            if part.names is not None:
+                self.names.update(part.names)
+        self.reset()
+
+    def compile(self, node):
+        """
+        Return the render function of the part `node`.
+        """
+        root = Root()
+        root.children = [node]
+        template = self.template
+        if not template.compiled:
+            return root.render
+        code, namespace = compiler.compile_tree(
+            root, template.name or '<template>', template.autoescape,
+            template.profiler is not None, template.budget is not None)
+        return compiler.load(code, namespace, _profiler=template.profiler)[0]
+
+    def reset(self):
+        """
+        Forget the previous render, the next one renders everything.
+        """
+        self.values = {}
+        self.output = [None] * len(self.parts)
+
+    def render(self, ctx=None):
+        self.update(ctx)
+        return ''.join(self.output)
+
+    def changes(self, ctx=None):
+        """
+        Render with `ctx`, return a list of the (index, output) of the
+        parts whose output is not what it was in the previous render.
+        """
+        return self.update(ctx)
+
+    def update(self, ctx):
+        context = self.template.new_context(ctx)
+        values, changed = {}, set()
+        for name in self.names:
+            value = values[name] = context.peek(name, _missing)
+            if not same(value, self.values.get(name, _missing)):
+                changed.add(name)
+
+        changes = []
+        for index, part in enumerate(self.parts):
+            old = self.output[index]
+            if old is not None and part.names is not None and \
+                    not part.names & changed:
+                continue
+            html = part.render(context)
+            if html != old:
+                self.output[index] = html
+                changes.append((index, html))
+        if context.meter is not None:
+            context.meter.check(sum(len(html) for html in self.output))
+        # Only once every part is up to date with them.
+        self.values = values
+        return changes
+
+
+def split(node):
+    """
+    Generator of the parts of the tree of `node`.
+    """
+    for child in node.children:
+        if isinstance(child, Block) or \
+                isinstance(child, Include) and child.linked:
+            for part in split(child):
+                yield part
+        else:
+            yield child
+
+
+def same(new, old):
+    """
+    Whether the value `new` of a name stands for the same as `old`.
+    """
+    if new is old:
+        return True
+    try:
+        return bool(new == old)
+    except Exception:
+        return False
@@ -5,80 +5,182 @@
 
 import re
 from collections import deque
+from itertools import chain
 
 import syntax
 from tokens import *
 from exc import TemplateSyntaxError
+from utils import Slotted
 
 c = lambda x: re.compile(x)
 _RE_MEGA = r'({0}.*?{1})|({2}.*?{3})|({4}.*?{5})'.format(*syntax.SYMBOLS)
+_RE_TAG = c(_RE_MEGA)
 
+# Marks a tag that eats the whitespace on its side: `{%- ... -%}`.
+TRIM = '-'
 
-class Token(object):
+# The group of _RE_MEGA that matched tells us the kind of tag.
+_TAG_TYPES = {
+    1: TOKEN_VAR,
+    2: TOKEN_BLOCK,
+    3: TOKEN_COMMENT,
+}
+
+
+class Token(Slotted):
     """
     Wrapper of each word Token seen in the source text.
     Along with the value of the token, some extra information is also
     stored as attributes.
+
+    The Lexer hands in the type and the cleaned up content of the
+    token as it scans, so that nothing has to look at the raw value
+    again. Tokens created by hand are classified from their value.
     """
 
-    def __init__(self, value, line_no=None, col_no=None):
-        # Lets get this thing working first.
-        # Take care of line number, col number later!
+    __slots__ = ('value', 'line_no', 'col_no', 'type', 'content', 'keyword',
+                 'template')
+
+    def __init__(self, value, line_no=None, col_no=None, token_type=None,
+                 content=None):
         self.value = value
         self.line_no = line_no
         self.col_no = col_no
-        self.type = self.get_token_type()
+        if token_type is None:
+            token_type, content = self.get_token_type()
+        elif content is None:
+            content = value
+        self.type = token_type
+        self.content = content
+        self.keyword = None
+        # The name of the template the token was read from, if known.
+        self.template = None
+        if token_type == TOKEN_BLOCK:
+            self.keyword = content.split(None, 1)[0] if content else None
+        self.check_token_syntax(token_type, content)
 
     def get_token_type(self):
         """
-        Analyse the token content and return the token type.
+        Analyse the token content and return the token type,
+        along with the content of the token.
         """
         token_begin = self.value[:2]
         token_end = self.value[-2:]
-        token_set = (token_begin, token_end)
-        if token_set[0] in syntax.SYMBOLS and token_set[1] in syntax.SYMBOLS:
-            token_content = self.value[2:-2].strip()
-            if token_content[:3] == 'end':
-                token_type = TOKEN_BLOCK_END
-            else:
-                token_type = TOKEN_DICT.get(token_begin)
-            self.check_token_syntax(token_type, token_content)
-        else:
-            token_type = TOKEN_HTML
-        return token_type
+        if token_begin in syntax.SYMBOLS and token_end in syntax.SYMBOLS:
+            return classify(TOKEN_DICT.get(token_begin), self.value)
+        return TOKEN_HTML, self.value
 
     def clean(self):
-        if self.type in [TOKEN_VAR, TOKEN_BLOCK]:
-            return ''.join(self.value[2:-2].strip())
-        return self.value
+        return self.content
 
     def check_token_syntax(self, token_type, token_content):
         """
         Some basic syntax analysis here, based on token types.
         """
         if token_type == TOKEN_BLOCK_END and len(token_content.split()) > 1:
-            raise TemplateSyntaxError('Invalid end token!')
+            raise TemplateSyntaxError(self.error('Invalid end token!'))
         elif token_type == TOKEN_BLOCK:
-            split = token_content.split()
-            if split[0] not in syntax.KEYWORDS:
-                raise TemplateSyntaxError('Invalid keyword - {0}'.format(
-                    split[0]))
+            if self.keyword not in syntax.KEYWORDS:
+                raise TemplateSyntaxError(self.error(
+                    'Invalid keyword - {0}'.format(self.keyword)))
+
+    def error(self, message):
+        """
+        Point `message` at the place this token was seen, if known.
+        """
+        if self.line_no is None:
+            return message
+        return '{0} (line {1}, column {2})'.format(
+            message, self.line_no, self.col_no)
 
     def __repr__(self):
         return '{0}'.format(self.value)
 
 
+def classify(tag_type, value):
+    """
+    Return the token type and content of the tag `value`, without
+    the whitespace control marks.
+    """
+    content = value[2:-2]
+    if content[:1] == TRIM:
+        content = content[1:]
+    if content[-1:] == TRIM:
+        content = content[:-1]
+    content = content.strip()
+    if tag_type == TOKEN_BLOCK and content[:3] == 'end':
+        return TOKEN_BLOCK_END, content
+    return tag_type, content
+
+
 class Lexer(object):
-    """A Regex based Lexer."""
+    """
+    A Regex based Lexer.
+
+    The source is scanned in a single pass: every tag is found with
+    `re.finditer`, the text in between is HTML. Tokens come out
+    classified, cleaned and with their line and column (both 1-based)
+    filled in.
+
+    A tag that starts with a `-`, like `{%- if x %}`, strips the
+    whitespace from the end of the HTML before it, and one that ends
+    with a `-`, like `{{ name -}}`, from the start of the HTML after it.
+    """
 
     def __init__(self, source_text):
-        self._source_text = source_text.strip()
-        self._source_list = [
-            e for e in re.split(_RE_MEGA, self._source_text) if e
-        ]
-        self._pos = 0
+        self._source_text = source_text
         self.current = TOKEN_INITIAL
         self._buffer = deque()
+        self._stream = self.scan()
+
+    def scan(self):
+        """
+        Generator of the Tokens in the source text.
+        """
+        source = self._source_text
+        # The whitespace around the template is left out, but lines and
+        # columns are counted from the start of the source.
+        pos = len(source) - len(source.lstrip())
+        limit = len(source.rstrip())
+        line_no = source.count('\n', 0, pos) + 1
+        line_start = source.rfind('\n', 0, pos) + 1
+        lstrip = False
+        # The None at the end stands for the text after the last tag.
+        for match in chain(_RE_TAG.finditer(source, pos, limit), [None]):
+            if match is None:
+                start = end = limit
+                value = ''
+            else:
+                start, end = match.span()
+                value = match.group()
+            html = source[pos:start]
+            if lstrip:
+                stripped = html.lstrip()
+                skipped = len(html) - len(stripped)
+                if skipped:
+                    newlines = source.count('\n', pos, pos + skipped)
+                    if newlines:
+                        line_no += newlines
+                        line_start = source.rfind(
+                            '\n', pos, pos + skipped) + 1
+                    pos += skipped
+                html = stripped
+            if value[2:3] == TRIM:
+                html = html.rstrip()
+            if html:
+                yield Token(html, line_no, pos - line_start + 1, TOKEN_HTML)
+            if match is None:
+                return
+            newlines = source.count('\n', pos, start)
+            if newlines:
+                line_no += newlines
+                line_start = source.rfind('\n', pos, start) + 1
+            token_type, content = classify(_TAG_TYPES[match.lastindex],
+                                           value)
+            yield Token(value, line_no, start - line_start + 1,
+                        token_type, content)
+            lstrip = value[-3] == TRIM
+            pos = end
 
     def push(self, item):
         self._buffer.append(item)
@@ -89,19 +191,24 @@ class Lexer(object):
         and return the next token. This does not
         affect the stream iterator.
         """
-        pass
+        if not self._buffer:
+            token = next(self._stream, None)
+            if token is None:
+                return None
+            self.push(token)
+        return self._buffer[0]
 
     def __iter__(self):
         """
         Generator stream that returns the next token in our buffer.
         """
-        #if self._pos >= len(self._source_text):
-        #    raise StopIteration
-        #else:
-        # print(self._source_list)
-        # import pdb; pdb.set_trace()
-        for text in self._source_list:
-            self.current = Token(text)
+        while True:
+            if self._buffer:
+                self.current = self._buffer.popleft()
+            else:
+                self.current = next(self._stream, None)
+                if self.current is None:
+                    return
             yield self.current
 
 
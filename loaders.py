@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Template Loaders.
+-----------------
+A Loader finds the source of a template by its name. Along with the
+source it returns the state of the file it read, so that whoever
+caches the parsed template can tell when it went out of date.
+"""
+
+import io
+import os
+
+from exc import TemplateNotFound
+from utils import string_types
+
+
+class FileSystemLoader(object):
+    """
+    Load templates from one or more directories. Template names are
+    paths relative to those directories, separated by '/'.
+    """
+
+    def __init__(self, searchpath, encoding='utf-8'):
+        if isinstance(searchpath, string_types):
+            searchpath = [searchpath]
+        self.searchpath = list(searchpath)
+        self.encoding = encoding
+
+    def find(self, name):
+        """
+        Return the path of the template called `name`.
+        """
+        pieces = [p for p in name.split('/') if p and p != '.']
+        if not pieces or '..' in pieces:
+            raise TemplateNotFound(name)
+        for directory in self.searchpath:
+            path = os.path.join(directory, *pieces)
+            if os.path.isfile(path):
+                return path
+        raise TemplateNotFound(name)
+
+    def get_state(self, path):
+        """
+        The state of a template file, as far as caching is concerned.
+        Returns None if the file is gone.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def get_source(self, name):
+        """
+        Return a (source, path, state) tuple for the template `name`.
+        """
+        path = self.find(name)
+        # Take the state before reading, a change that sneaks in
+        # between the two will then be caught on the next check.
+        state = self.get_state(path)
+        try:
+            with io.open(path, encoding=self.encoding) as f:
+                source = f.read()
+        except IOError:
+            raise TemplateNotFound(name)
+        return source, path, state
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTML Escaping.
+--------------
+With autoescape on, the value of every Variable is escaped before it
+goes into the output. Values that are safe already are marked as such,
+by being a Markup, or by having an `__html__` method that returns the
+markup for them, and are inserted as they are.
+"""
+
+import re
+
+from utils import string_types
+
+_RE_SPECIAL = re.compile('[&<>"\']')
+
+# Escape values up to this length are remembered for the rest of
+# a render, longer ones are unlikely to come around again.
+CACHE_MAX_LENGTH = 256
+
+
+class Markup(str):
+    """
+    A string that is safe to insert into HTML as it is.
+    """
+
+    __slots__ = ()
+
+    def __html__(self):
+        return self
+
+    def __repr__(self):
+        return 'Markup({0})'.format(str.__repr__(self))
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;') \
+        .replace('>', '&gt;').replace('"', '&#34;').replace("'", '&#39;')
+
+
+def escape(value):
+    """
+    Return `value` as a Markup, with the HTML special characters
+    escaped unless it is safe already.
+    """
+    if hasattr(value, '__html__'):
+        return Markup(value.__html__())
+    text = value if isinstance(value, string_types) else str(value)
+    if _RE_SPECIAL.search(text) is None:
+        return Markup(text)
+    return Markup(_escape(text))
+
+
+def escaper():
+    """
+    Return an escape function for a single render. It turns None into
+    '' like the rest of rendering does, skips the work for strings
+    without anything to escape, and remembers what it escaped so that
+    a value repeating throughout the render is only escaped once.
+    """
+    cache = {}
+    search = _RE_SPECIAL.search
+
+    def escape_value(value):
+        if value is None:
+            return ''
+        if hasattr(value, '__html__'):
+            return value.__html__()
+        if not isinstance(value, string_types):
+            value = str(value)
+        try:
+            return cache[value]
+        except KeyError:
+            pass
+        rv = value if search(value) is None else _escape(value)
+        if len(value) <= CACHE_MAX_LENGTH:
+            cache[value] = rv
+        return rv
+    return escape_value
@@ -1,30 +1,41 @@
 from lexer import Lexer
 from tokens import *
-from utils import resolve, eval_expression
-from exc import TemplateSyntaxError
+from utils import eval_expression, operand, Accessor, Constant, \
+    string_types, Slotted
+from exc import TemplateSyntaxError, TemplateError
 from syntax import OP_TABLE
+from context import LoopContext
+import filters
 
+import copy
 import re
 
 
-class _Node(object):
+class _Node(Slotted):
     """
     Take a Token and make a Node item out of it,
     each node has a parent and multiple children.
     """
     # Each node has its own allowed fields, which could be
-    # other nodes, lists or any other type of value.
+    # other nodes, lists or any other type of value. They are
+    # declared in __slots__, there can be a lot of nodes around.
+    __slots__ = ('token', 'children')
 
     creates_scope = False
+    # Leaves never have children, they all share an empty tuple.
+    leaf = False
 
     def __init__(self, token=None):
         self.token = token
-        self.children = []
+        self.children = () if self.leaf else []
         self.process_token(self.token)
 
     def process_token(self, token):
         pass
 
+    def add_child(self, node):
+        self.children.append(node)
+
     def render_children(self, context, children=None):
         if children is None:
             children = self.children
@@ -36,9 +47,26 @@ class _Node(object):
         # Render all the children!
         return ''.join(map(render_child, children))
 
+    def stream_children(self, context, children=None):
+        if children is None:
+            children = self.children
+        for child in children:
+            for chunk in child.stream(context):
+                yield chunk
+
     def render(self, context):
         pass
 
+    def stream(self, context):
+        """
+        Generator of the rendered output of this node, in chunks.
+        Nodes with children override this to stream them one by one,
+        instead of rendering them all into a single string.
+        """
+        html = self.render(context)
+        if html is not None:
+            yield str(html)
+
     def enter_scope(self):
         pass
 
@@ -50,25 +78,67 @@ class _Node(object):
 
 
 class _ScopedNode(_Node):
+    __slots__ = ()
     creates_scope = True
 
 
 class Root(_Node):
+    __slots__ = ()
 
     def render(self, context):
         return self.render_children(context)
 
+    def stream(self, context):
+        return self.stream_children(context)
+
 
 class Variable(_Node):
+    """
+    :token: {{ name }}
+    :token: {{ name|filter|filter(args) }}
+
+    A Variable whose value is a literal is worked out once, filters
+    and all, `constant` tells whether that was the case.
+    """
+
+    __slots__ = ('filters', 'constant', 'accessor', 'value')
+    leaf = True
 
     def process_token(self, token=None):
         if token.type == TOKEN_VAR:
-            return token.value
+            try:
+                expr, self.filters = filters.parse(token.clean())
+            except TemplateSyntaxError as e:
+                raise TemplateSyntaxError(token.error(str(e)))
+            base = operand(expr)
+            self.constant = isinstance(base, Constant)
+            if self.constant:
+                self.accessor = None
+                self.value = self.apply_filters(base.value)
+            else:
+                self.accessor = base
+                self.value = None
         else:
             raise TypeError
 
+    def apply_filters(self, value):
+        if self.filters is None:
+            return value
+        return self.filters(value)
+
     def render(self, context):
-        return resolve(self.token.clean(), context)
+        if self.constant:
+            value = self.value
+        elif self.filters is None:
+            value = self.accessor(context)
+        else:
+            value = self.filters(self.accessor(context))
+        if context.escape is not None:
+            value = context.escape(value)
+        if context.meter is not None and value is not None:
+            value = str(value)
+            context.meter.write(len(value))
+        return value
 
 
 class For(_ScopedNode):
@@ -79,6 +149,9 @@ class For(_ScopedNode):
         - Body: list of nodes in loop body.
         - Else: list of nodes for the else block.
     """
+
+    __slots__ = ('_loop_var', '_iter')
+
     def process_token(self, token):
         """
         :token: for i in [1, 2, 3]
@@ -87,7 +160,7 @@ class For(_ScopedNode):
         # Evaluate the iterable and then render
         # the result items individually.
         try:
-            loop = re.split('\s+', token.clean(), 3)
+            loop = re.split(r'\s+', token.clean(), 3)
             if len(loop) != 4 or loop[2] != 'in':
                 raise TemplateSyntaxError('Invalid for loop expression!')
             else:
@@ -95,95 +168,153 @@ class For(_ScopedNode):
                 iterable = loop[-1]
                 # Add the variable name to the current scope
             self._iter = eval_expression(iterable)
+            if self._iter[0] == 'name':
+                self._iter = 'name', Accessor(self._iter[1])
         except ValueError:
             raise SyntaxError(token)
 
-    def render(self, context):
+    def iterable(self, context):
         if self._iter[0] == 'literal':
-            items = self._iter[1]
+            return self._iter[1]
         elif self._iter[0] == 'name':
-            items = resolve(self._iter[1], context)
+            return self._iter[1](context)
 
-        # Since Py2.x can't mutate parent scope variables,
-        # we use a dictionary to pass in the index to the function below.
-        nonlocals = {'index': 0}
+    def start(self, context):
+        """
+        Return the items to loop over, and the `loop` variable for them.
+        """
+        items = self.iterable(context)
+        if not hasattr(items, '__len__'):
+            if context.meter is not None:
+                items = context.meter.take(items)
+            else:
+                items = list(items)
+        return items, LoopContext(len(items))
 
-        def render_item(item):
-            # Add the current item to be rendered into the context.
-            context[self._loop_var] = item
-            context['index'] = nonlocals['index']
-            nonlocals['index'] += 1
-            return self.render_children(context, self.children)
+    def iterate(self, context):
+        """
+        Enter the scope of the loop, then step through the items,
+        with the loop variables of each one set in that scope.
+        """
+        items, loop = self.start(context)
+        meter = context.meter
+        if meter is not None:
+            meter.loop(loop.length)
+        frame = context.push({'loop': loop})
+        try:
+            for index, item in enumerate(items):
+                if meter is not None:
+                    meter.check_time()
+                loop.index = index
+                frame[self._loop_var] = item
+                frame['index'] = index
+                yield item
+        finally:
+            context.pop()
+
+    def render(self, context):
+        return ''.join([self.render_children(context)
+                        for _ in self.iterate(context)])
 
-        return ''.join(map(render_item, items))
+    def stream(self, context):
+        for _ in self.iterate(context):
+            for chunk in self.stream_children(context):
+                yield chunk
+
+
+class Condition(Slotted):
+    """
+    The test of an If, parsed once into operands and an operator.
+
+    :if items:          -> bool(items)
+    :if num > 5:        -> num > 5
+    :if item is None:   -> item is None
+    :if item is not 0:  -> item is not 0
+
+    A condition on literals alone is worked out right away, `constant`
+    tells whether that was the case.
+    """
+
+    __slots__ = ('op', 'left', 'right', 'constant', 'value')
+
+    def __init__(self, conditional):
+        length = len(conditional)
+        if length == 2:
+            self.op = None
+        elif length == 4 or length == 5:
+            op_name = ' '.join(conditional[2:-1])
+            self.op = OP_TABLE.get(op_name)
+            if self.op is None:
+                if length == 5:
+                    raise TemplateSyntaxError('Invalid If expression!')
+                raise TemplateSyntaxError(
+                    'Invalid operator: {0}'.format(op_name))
+        else:
+            raise TemplateSyntaxError('Invalid If expression!')
+        self.left = operand(conditional[1])
+        self.right = operand(conditional[-1])
+        self.constant = isinstance(self.left, Constant) and \
+            isinstance(self.right, Constant)
+        self.value = self.evaluate(None) if self.constant else None
+
+    def evaluate(self, context):
+        if self.op is None:
+            return bool(self.right(context))
+        return self.op(self.left(context), self.right(context))
+
+    def __call__(self, context):
+        if self.constant:
+            return self.value
+        return self.evaluate(context)
 
 
 class If(_ScopedNode):
 
+    __slots__ = ('condition', 'else_node')
+
     def process_token(self, token):
         """
         :token: if (test)
         """
+        self.else_node = None
         try:
-            self.conditional = re.split('\s+', token.clean(), 4)
-            length = len(self.conditional)
-            if length != 2 and length != 4 and length != 5:
-                raise TemplateSyntaxError('Invalid If expression!')
-        except ValueError:
-            raise SyntaxError(token)
+            self.condition = Condition(re.split(r'\s+', token.clean(), 4))
+        except TemplateSyntaxError as e:
+            raise TemplateSyntaxError(token.error(str(e)))
+
+    def add_child(self, node):
+        # The Else is kept apart from the children of the If,
+        # so that it need not be searched for on every render.
+        if isinstance(node, Else):
+            self.else_node = node
+        else:
+            self.children.append(node)
+
+    def branch(self, context):
+        """
+        The children to render for `context`, None if there are none.
+        """
+        if self.condition(context):
+            return self.children
+        elif self.else_node is not None:
+            return self.else_node.children
+
+    def stream(self, context):
+        children = self.branch(context)
+        if children is not None:
+            for chunk in self.stream_children(context, children):
+                yield chunk
 
     def render(self, context):
-        self._ctx = context
-        self._test = self.eval_condition(self.conditional)
-        else_node = self.check_else(self.conditional)
-        children = None
-        render = True
-        if self._test:
-            children = self.children
-        elif else_node and not self._test:
-            children = else_node.children
-        else:
-            render = False
-        if render:
-            rendered_children = self.render_children(context, children)
-            return ''.join(rendered_children)
-
-    def check_else(self, cond):
-        for item in self.children:
-            if isinstance(item, Else):
-                return item
-
-    def resolve_in_expression(self, expr, ctx):
-        expr_type, expr = eval_expression(expr)
-        if expr_type == 'name' and expr:
-            resolved = resolve(expr, ctx)
-            return eval_expression(resolved)[1] if resolved else None
-        elif expr_type == 'literal':
-            return expr
-
-    def eval_condition(self, cond):
-        ctx = self._ctx
-        # cond[0] will be the token, skip.
-        left = self.resolve_in_expression(cond[1], ctx)
-        right = self.resolve_in_expression(cond[-1], ctx)
-        if len(cond) == 4:
-            op = OP_TABLE.get(cond[2], None)
-            if not op and cond[2] != 'is':
-                raise TemplateSyntaxError('Invalid operator: {}'.format(
-                    cond[2]))
-            elif cond[2] == 'is':
-                return bool(left is right)
-            return op(left, right)
-        if len(cond) == 5:
-            if cond[2] != 'is' or cond[3] != 'not':
-                raise TemplateSyntaxError('Invalid If expression!')
-            else:
-                return bool(left is not right)
-        return bool(right)
+        children = self.branch(context)
+        if children is not None:
+            return self.render_children(context, children)
 
 
 class Else(_ScopedNode):
 
+    __slots__ = ()
+
     def process_token(self, token):
         pass
 
@@ -193,8 +324,341 @@ class Else(_ScopedNode):
 
 class HTML(_Node):
 
+    __slots__ = ()
+    leaf = True
+
     def process_token(self, token):
         self.token = token
 
     def render(self, context):
+        if context.meter is not None:
+            context.meter.write(len(self.token.value))
         return self.token
+
+
+class Cache(_ScopedNode):
+    """
+    A fragment whose output is kept in the fragment cache of the render
+    (`context.fragments`), under a key that can take values from the
+    context, for `ttl` seconds if given:
+
+    :token: cache "sidebar"
+    :token: cache "sidebar-{user.id}-{lang}" 300
+    :token: cache page.slug 60
+
+    Renders without a fragment cache render the children every time.
+    """
+
+    __slots__ = ('parts', 'ttl')
+
+    _RE_CACHE = re.compile(
+        r'^cache\s+("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|\S+)'
+        r'(?:\s+(\S+))?$')
+    _RE_FIELD = re.compile(r'\{([^{}]+)\}')
+
+    def process_token(self, token):
+        match = self._RE_CACHE.match(token.clean())
+        if match is None:
+            raise TemplateSyntaxError(token.error('Invalid cache expression!'))
+        key, ttl = match.groups()
+        expr_type, value = eval_expression(key)
+        if expr_type == 'name':
+            self.parts = [Accessor(value)]
+        elif isinstance(value, string_types):
+            # Every other part is a field: "a-{b}" -> ['a-', 'b', ''].
+            self.parts = self._RE_FIELD.split(value)
+            self.parts[1::2] = [Accessor(name.strip())
+                                for name in self.parts[1::2]]
+        else:
+            raise TemplateSyntaxError(token.error('Invalid cache key!'))
+        self.ttl = None
+        if ttl is not None:
+            expr_type, self.ttl = eval_expression(ttl)
+            if expr_type != 'literal' or \
+                    not isinstance(self.ttl, (int, float)):
+                raise TemplateSyntaxError(token.error('Invalid cache ttl!'))
+
+    def key(self, context):
+        return ''.join(part if isinstance(part, string_types)
+                       else str(part(context)) for part in self.parts)
+
+    def lookup(self, context):
+        """
+        Return the key of the fragment for `context`, and the fragment
+        if it is in the cache, None otherwise.
+        """
+        if context.fragments is None:
+            return None, None
+        key = self.key(context)
+        return key, context.fragments.get(key)
+
+    def store(self, context, key, html):
+        if context.fragments is not None:
+            context.fragments.set(key, html, self.ttl)
+
+    def render(self, context):
+        key, html = self.lookup(context)
+        if html is None:
+            html = self.render_children(context)
+            self.store(context, key, html)
+        elif context.meter is not None:
+            # What is rendered counts as it goes, a cached fragment
+            # all at once.
+            context.meter.write(len(html))
+        return html
+
+
+class Include(_Node):
+    """
+    Renders another template in place, with the same context:
+
+    :token: include "row.html"
+    :token: include page.partial
+
+    A template with a literal name is linked in when the including
+    template is loaded: the Include gets the tree of the included
+    template as its children, shared and not copied, so nothing is
+    looked up when rendering. A name that comes from the context is
+    loaded from the Environment of the render every time.
+    """
+
+    __slots__ = ('name', 'linked')
+
+    def process_token(self, token):
+        split = token.clean().split(None, 1)
+        if len(split) != 2:
+            raise TemplateSyntaxError(token.error(
+                'Invalid include expression!'))
+        expr_type, name = eval_expression(split[1])
+        if expr_type == 'name':
+            name = Accessor(name)
+        elif not isinstance(name, string_types):
+            raise TemplateSyntaxError(token.error(
+                'Invalid include expression!'))
+        self.name = name
+        self.linked = False
+
+    @property
+    def static(self):
+        return isinstance(self.name, string_types)
+
+    def link(self, root):
+        """
+        Return a copy of this Include with the tree `root` linked in.
+        """
+        node = copy.copy(self)
+        node.children = root.children
+        node.linked = True
+        return node
+
+    def template(self, context):
+        """
+        The template to include for `context`, if it isn't linked.
+        """
+        name = self.name if self.static else self.name(context)
+        if context.env is None:
+            raise TemplateError(
+                'Cannot include "{0}": no Environment to load it from'
+                .format(name))
+        return context.env.get_template(name)
+
+    def render(self, context):
+        if self.linked:
+            return self.render_children(context)
+        return self.template(context).render_context(context)
+
+    def stream(self, context):
+        if self.linked:
+            return self.stream_children(context)
+        return self.template(context).stream_context(context)
+
+
+class Block(_ScopedNode):
+    """
+    A named part of a template, which templates that extend it
+    can override.
+    """
+
+    __slots__ = ('name',)
+
+    def process_token(self, token):
+        """
+        :token: block content
+        """
+        split = token.clean().split()
+        if len(split) != 2:
+            raise TemplateSyntaxError(token.error('Invalid block expression!'))
+        self.name = split[1]
+
+    def render(self, context):
+        return self.render_children(context)
+
+    def stream(self, context):
+        return self.stream_children(context)
+
+
+class Extends(_Node):
+    """
+    Marks a template as extending the template `parent`. Templates are
+    flattened once they are loaded, so these never get rendered.
+    """
+
+    __slots__ = ('parent',)
+    leaf = True
+
+    def process_token(self, token):
+        """
+        :token: extends "base.html"
+        """
+        split = token.clean().split(None, 1)
+        expr_type, parent = eval_expression(split[-1])
+        if len(split) != 2 or expr_type != 'literal' or \
+                not isinstance(parent, string_types):
+            raise TemplateSyntaxError(token.error(
+                'Invalid extends expression!'))
+        self.parent = parent
+
+
+def walk(node):
+    """
+    Generator of `node` and all the nodes below it.
+    """
+    yield node
+    for child in node.children:
+        for item in walk(child):
+            yield item
+    else_node = getattr(node, 'else_node', None)
+    if else_node is not None:
+        for item in walk(else_node):
+            yield item
+
+
+def find_blocks(root):
+    """
+    Return the Blocks in a tree, by name.
+    """
+    return dict((node.name, node) for node in walk(root)
+                if isinstance(node, Block))
+
+
+def find_names(node):
+    """
+    Return the set of names that `node` and the nodes below it look up
+    in the context, leaving out the ones bound by the loops among them.
+    Only the first part of a dotted name counts.
+    """
+    names = set()
+    if isinstance(node, Variable):
+        if not node.constant:
+            names.add(node.accessor.head)
+    elif isinstance(node, If):
+        condition = node.condition
+        operands = [condition.right]
+        if condition.op is not None:
+            operands.append(condition.left)
+        for item in operands:
+            if isinstance(item, Accessor):
+                names.add(item.head)
+    elif isinstance(node, For):
+        if node._iter[0] == 'name':
+            names.add(node._iter[1].head)
+    elif isinstance(node, Cache):
+        names.update(part.head for part in node.parts
+                     if isinstance(part, Accessor))
+    elif isinstance(node, Include) and not node.static:
+        names.add(node.name.head)
+    inner = set()
+    for child in node.children:
+        inner.update(find_names(child))
+    else_node = getattr(node, 'else_node', None)
+    if else_node is not None:
+        inner.update(find_names(else_node))
+    if isinstance(node, For):
+        inner.difference_update((node._loop_var, 'loop', 'index'))
+    return names | inner
+
+
+def find_extends(root):
+    """
+    Return the Extends node of a tree, None if it doesn't extend anything.
+    """
+    found = [node for node in root.children if isinstance(node, Extends)]
+    if len(found) > 1:
+        raise TemplateSyntaxError(found[1].token.error(
+            'A template can only extend one template!'))
+    return found[0] if found else None
+
+
+def rebuild(node, replace):
+    """
+    Return the tree of `node` with the nodes `replace` gives a node for
+    swapped for it. `replace` returns None for the nodes to leave be,
+    whose children are gone through in turn. Only the nodes on the way
+    to a swapped node get copied, the rest of the tree is shared.
+    """
+    new = replace(node)
+    if new is not None:
+        return new
+    children = [rebuild(child, replace) for child in node.children]
+    else_node = getattr(node, 'else_node', None)
+    if else_node is not None:
+        else_node = rebuild(else_node, replace)
+    if all(a is b for a, b in zip(children, node.children)) and \
+            else_node is getattr(node, 'else_node', None):
+        return node
+    node = copy.copy(node)
+    node.children = children
+    if else_node is not None:
+        node.else_node = else_node
+    return node
+
+
+def override_blocks(node, blocks):
+    """
+    Return the tree of `node` with each Block swapped for the Block of
+    the same name in `blocks`.
+    """
+    def replace(node):
+        if isinstance(node, Block):
+            return blocks.get(node.name)
+        elif isinstance(node, Include) and node.linked:
+            # The blocks of an included template are its own.
+            return node
+    return rebuild(node, replace)
+
+
+def find_includes(roots):
+    """
+    Return the names of the templates that the trees `roots` include
+    by a literal name, and haven't linked in yet.
+    """
+    names = []
+    for root in roots:
+        for node in walk(root):
+            if isinstance(node, Include) and node.static and \
+                    not node.linked and node.name not in names:
+                names.append(node.name)
+    return names
+
+
+def link_includes(root, templates):
+    """
+    Return the tree of `root` with its Includes of a literal name
+    linked to the tree of the template of that name in `templates`.
+    """
+    def replace(node):
+        if isinstance(node, Include) and node.static:
+            if node.linked:
+                return node
+            return node.link(templates[node.name].root)
+    return rebuild(root, replace)
+
+
+def inherit(parent, child):
+    """
+    Flatten the tree `child` of a template that extends the template
+    with the tree `parent` into a single tree: the parent's tree, with
+    the blocks the child overrides swapped in. Anything the child has
+    outside of its blocks is dropped.
+    """
+    return override_blocks(parent, find_blocks(child))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parse Tree Optimizer.
+---------------------
+The Parser keeps every piece of a template as it was written, which
+leaves work for every render that could have been done just once.
+The optimizer goes over the tree after parsing and:
+
+- drops the branch of an If whose condition is made of literals, and
+  puts the children of the other branch in place of the If,
+- works out Variables with a literal value, filters and all,
+- renders For loops over a small literal list ahead of time, if their
+  body looks up nothing but the variables of the loop,
+- merges the HTML that ends up side by side into a single node,
+- collapses the runs of whitespace in the HTML of the template, if
+  asked to, before any literal is folded into it.
+
+Blocks are kept as they are, since templates that extend this one
+may override them, and so are loops with a Block or an Include in
+their body. The tree renderer and the compiler both render the
+optimized tree.
+"""
+
+import copy
+import re
+
+import markup
+from context import Context
+from lexer import Token
+from nodes import HTML, If, For, Block, Include, Variable, walk, \
+    find_names
+from tokens import TOKEN_HTML
+
+# Loops over a literal with more items than this are left alone.
+MAX_UNROLL = 100
+
+_RE_WHITESPACE = re.compile(r'\s+')
+
+
+class Optimizer(object):
+    """
+    :autoescape: Whether the template escapes the value of Variables.
+    :collapse_whitespace: Whether to collapse the whitespace in HTML.
+    """
+
+    def __init__(self, autoescape=False, collapse_whitespace=False,
+                 max_unroll=MAX_UNROLL):
+        self.autoescape = autoescape
+        self.collapse_whitespace = collapse_whitespace
+        self.max_unroll = max_unroll
+
+    def optimize(self, node):
+        """
+        Return the optimized tree of `node`. Nodes that don't change
+        are shared with the original tree, the rest are copies.
+        """
+        children = self.optimize_children(node.children)
+        else_node = getattr(node, 'else_node', None)
+        if else_node is not None:
+            else_node = self.optimize(else_node)
+        if len(children) == len(node.children) and \
+                all(a is b for a, b in zip(children, node.children)) and \
+                else_node is getattr(node, 'else_node', None):
+            return node
+        node = copy.copy(node)
+        node.children = children
+        if else_node is not None:
+            node.else_node = else_node
+        return node
+
+    def optimize_children(self, children):
+        """
+        Return the optimized list of `children`, with the HTML nodes
+        that end up next to each other merged.
+        """
+        result = []
+        for child in children:
+            for node in self.replace(child):
+                if not isinstance(node, HTML):
+                    result.append(node)
+                elif not node.token.value:
+                    continue
+                elif result and isinstance(result[-1], HTML):
+                    result[-1] = merge(result[-1], node)
+                else:
+                    result.append(node)
+        return result
+
+    def replace(self, node):
+        """
+        Return the list of nodes to put in place of `node`.
+        """
+        if isinstance(node, HTML):
+            # Only the HTML of the template is collapsed, not what
+            # literals render to.
+            if self.collapse_whitespace:
+                return [collapse(node)]
+            return [node]
+        elif isinstance(node, Variable) and node.constant:
+            if node.value is None:
+                return []
+            value = node.value
+            if self.autoescape:
+                value = markup.escape(value)
+            return [text(str(value), node.token)]
+        elif isinstance(node, If) and node.condition.constant:
+            if node.condition.value:
+                return self.optimize_children(node.children)
+            elif node.else_node is not None:
+                return self.optimize_children(node.else_node.children)
+            return []
+        node = self.optimize(node)
+        if isinstance(node, For) and self.can_prerender(node):
+            try:
+                html = node.render(self.new_context())
+            except Exception:
+                # Let the error come up when the template is rendered.
+                return [node]
+            return [text(html, node.token)]
+        return [node]
+
+    def can_prerender(self, node):
+        """
+        Whether the output of the For `node` is the same for every
+        render: it loops over a few literals and only reads its own
+        variables, with nothing that could be overridden inside.
+        """
+        if node._iter[0] != 'literal':
+            return False
+        try:
+            if len(node._iter[1]) > self.max_unroll:
+                return False
+        except TypeError:
+            return False
+        if find_names(node):
+            return False
+        return not any(isinstance(child, (Block, Include))
+                       for child in walk(node))
+
+    def new_context(self):
+        if self.autoescape:
+            return Context(None, markup.escaper())
+        return Context()
+
+
+def text(value, token):
+    """
+    An HTML node with the text `value`, placed where `token` was.
+    """
+    return HTML(Token(value, token.line_no, token.col_no, TOKEN_HTML))
+
+
+def merge(first, second):
+    """
+    An HTML node with the text of `first` followed by that of `second`.
+    """
+    return text(first.token.value + second.token.value, first.token)
+
+
+def collapse(node):
+    """
+    The HTML `node` with every run of whitespace in its text made a
+    single newline if there was one in it, a single space otherwise.
+    Whitespace that matters, like that in a <pre>, is not spared.
+    """
+    value = _RE_WHITESPACE.sub(
+        lambda match: '\n' if '\n' in match.group() else ' ',
+        node.token.value)
+    if value == node.token.value:
+        return node
+    return text(value, node.token)
+
+
+def optimize(root, autoescape=False, collapse_whitespace=False):
+    """
+    Return the optimized parse tree of `root`.
+    """
+    return Optimizer(autoescape, collapse_whitespace).optimize(root)
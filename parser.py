@@ -19,9 +19,16 @@ from nodes import *
 from tokens import *
 from exc import TemplateSyntaxError
 
-# Scope stack. Push when entering a scope, pop while exiting.
-# Stack size should be zero at the end of a template render.
-SCOPE_STACK = []
+# Block keywords and the Nodes they create.
+BLOCK_NODES = {
+    'if': If,
+    'for': For,
+    'else': Else,
+    'block': Block,
+    'cache': Cache,
+    'extends': Extends,
+    'include': Include,
+}
 
 
 class Parser(object):
@@ -38,13 +45,7 @@ class Parser(object):
         elif token.type == TOKEN_VAR:
             node_cls = Variable
         elif token.type == TOKEN_BLOCK:
-            token_val = token.clean()
-            if 'if' in token_val:
-                node_cls = If
-            elif 'for' in token_val:
-                node_cls = For
-            elif 'else' in token_val:
-                node_cls = Else
+            node_cls = BLOCK_NODES.get(token.keyword)
 
         if node_cls:
             node = node_cls(token)
@@ -53,8 +54,8 @@ class Parser(object):
         elif not node_cls and token.type != TOKEN_BLOCK_END:
             # The end blocks are just for popping out of scope,
             # no need for actual Node objects
-            raise TemplateSyntaxError("Failed to Parse token: {0}".format(
-                token))
+            raise TemplateSyntaxError(token.error(
+                "Failed to Parse token: {0}".format(token)))
         else:
             raise TemplateSyntaxError("Invalid Syntax")
 
@@ -70,10 +71,14 @@ class Parser(object):
         """
         root_token = Root()
         scope_stack = [root_token]
+        blocks = set()
         for token in self.stream:
             if token:
                 parent = scope_stack[-1]
                 if token.type == TOKEN_BLOCK_END:
+                    if len(scope_stack) == 1:
+                        raise TemplateSyntaxError(token.error(
+                            'Unexpected end tag: {0}'.format(token.clean())))
                     # parent.exit_scope()
                     item = scope_stack.pop()
                     popped_token = item.token.clean()
@@ -81,8 +86,13 @@ class Parser(object):
                         scope_stack.pop()
                     continue           # We don't create Nodes for End Tokens!
                 node = self.create_node(token)
+                if isinstance(node, Block):
+                    if node.name in blocks:
+                        raise TemplateSyntaxError(token.error(
+                            'Block defined twice: {0}'.format(node.name)))
+                    blocks.add(node.name)
                 if node:
-                    parent.children.append(node)
+                    parent.add_child(node)
                     if node.creates_scope:
                         scope_stack.append(node)
                         node.enter_scope()
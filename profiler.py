@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Render Profiler.
+----------------
+A template rendered with a Profiler records the number of calls and
+the cumulative time spent in each of its For, If and Variable nodes,
+keyed by template name, line and column:
+
+    profiler = Profiler()
+    template = Tortoise(text, name='page.html', profiler=profiler)
+    template.render(ctx)
+    print(profiler.report())
+
+The timing code is compiled into the render function of templates that
+have a Profiler, and left out of every other one, so profiling costs
+nothing unless it is turned on. Times are cumulative: the time of a For
+includes that of the nodes in its body. When streaming, the time spent
+by the consumer of a chunk counts towards the node that yielded it.
+A Profiler can be shared by templates rendered in several threads.
+"""
+
+from threading import Lock
+
+
+class Profiler(object):
+    """
+    :callback: Called as `callback(key, seconds)` for every node
+               rendered, on top of the numbers the Profiler keeps.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        # (template, line, column, tag) -> [calls, seconds]
+        self.stats = {}
+        self._lock = Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            try:
+                entry = self.stats[key]
+            except KeyError:
+                entry = self.stats[key] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+        if self.callback is not None:
+            self.callback(key, seconds)
+
+    def entries(self):
+        """
+        The recorded (key, calls, seconds), slowest first.
+        """
+        with self._lock:
+            entries = [(key, calls, seconds)
+                       for key, (calls, seconds) in self.stats.items()]
+        return sorted(entries, key=lambda entry: entry[2], reverse=True)
+
+    def report(self, limit=20):
+        """
+        A table of the `limit` nodes that took the most time.
+        """
+        lines = ['{0:>10} {1:>8} {2:>10}  {3}'.format(
+            'total ms', 'calls', 'per call', 'location')]
+        for key, calls, seconds in self.entries()[:limit]:
+            template, line, column, tag = key
+            lines.append('{0:>10.3f} {1:>8} {2:>10.4f}  {3}:{4}:{5} {6}'
+                         .format(seconds * 1e3, calls, seconds * 1e3 / calls,
+                                 template, line, column, tag))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+    def __getstate__(self):
+        # Locks can't be pickled, a copy gets a lock of its own.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
@@ -6,6 +6,8 @@ import operator
 
 KEYWORDS = """
 block
+cache
+endcache
 extends
 for
 endfor
@@ -13,6 +15,7 @@ if
 else
 endif
 in
+include
 """.split()
 
 SYMBOLS = """
@@ -30,11 +33,13 @@ OP_TABLE = {
     '<=': operator.le,
     '>=': operator.ge,
     '==': operator.eq,
-    '!=': operator.ne
+    '!=': operator.ne,
+    'is': operator.is_,
+    'is not': operator.is_not,
 }
 
-VARIABLE_STARTCHARS = string.letters
-VARIABLE_CHARS = string.letters + string.digits + '_'
+VARIABLE_STARTCHARS = string.ascii_letters
+VARIABLE_CHARS = string.ascii_letters + string.digits + '_'
 WHITESPACE_CHARS = " \n\t"
 STRING_CHARS = '"' + "'"
-BLOCKNAME_CHARS = string.letters
+BLOCKNAME_CHARS = string.ascii_letters
@@ -1,5 +1,38 @@
-from unittest import TestCase
+import functools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from unittest import TestCase, skipIf
 from tortoise import Tortoise
+from lexer import Lexer
+from tokens import TOKEN_HTML, TOKEN_VAR, TOKEN_BLOCK, TOKEN_BLOCK_END
+from cache import LRUCache
+from environment import Environment
+from bccache import FileSystemBytecodeCache
+import parser
+import compiler
+import filters
+import optimizer
+import pickle
+from loaders import FileSystemLoader
+from exc import TemplateNotFound, TemplateContextError, TemplateSyntaxError, \
+    TemplateError, TemplateBudgetExceeded
+from utils import Accessor, resolve
+from markup import Markup, escape, escaper
+from profiler import Profiler
+from budget import Budget
+from nodes import For, Block, find_names, walk
+from context import Context, Lazy
+import tortoise
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
 # Test cases picked from microtemplates and 500lines
 
@@ -14,6 +47,56 @@ class AnyOldObject(object):
         return 'func!'
 
 
+class Sink(object):
+    """
+    A file-like object that remembers every write.
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def getvalue(self):
+        return ''.join(self.writes)
+
+
+class Deferred(object):
+    """
+    An awaitable that gives `value` after `delay` seconds, and counts
+    how often it is awaited.
+    """
+
+    def __init__(self, value, delay=0):
+        self.value = value
+        self.delay = delay
+        self.awaited = 0
+
+    def __await__(self):
+        self.awaited += 1
+        # Wrapped in a Task, since sleep() has no __await__ before 3.7.
+        return asyncio.ensure_future(
+            asyncio.sleep(self.delay, self.value)).__await__()
+
+
+class AsyncCallable(object):
+    """
+    An object whose `__call__` is a coroutine function.
+    """
+
+    __call__ = staticmethod(functools.partial(asyncio.sleep, 0, 'called')
+                            if asyncio is not None else None)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
 class TortoiseTest(TestCase):
     def try_render(self, text, ctx=None, result=None):
         """
@@ -26,6 +109,22 @@ class TortoiseTest(TestCase):
         if result:
             self.assertEqual(result, actual)
 
+    def test_names_starting_with_end(self):
+        templ = Tortoise('{{ endpoint }}{% if end_date %}!{% endif %}')
+        self.assertEqual(templ.render({'endpoint': '/a', 'end_date': 1}),
+                         '/a!')
+
+    def test_unmatched_end_tag(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Tortoise('a{% endif %}')
+        self.assertIn('Unexpected end tag: endif (line 1, column 2)',
+                      str(cm.exception))
+
+    def test_loop_variable_names(self):
+        templ = Tortoise('{% for loop in items %}{{ loop }}{% endfor %}\
+{% for index in items %}{{ index }}{% endfor %}')
+        self.assertEqual(templ.render({'items': [7, 8]}), '7801')
+
     def test_passthrough(self):
         """
         Strigs without variables are passed through unchanged.
@@ -153,3 +252,1208 @@ yes\
 {% endif %}\
 {% endfor %}').render({'items': ['', None, '2']})
         self.assertEquals(rendered, 'yes')
+
+    def test_keyword_inside_name(self):
+        # Blocks are told apart by their keyword, not by substrings.
+        rendered = Tortoise('{% for gift in items %}{{ gift }}\
+{% endfor %}').render({'items': ['a', 'b']})
+        self.assertEqual(rendered, 'ab')
+
+    def test_for_leaves_context_alone(self):
+        ctx = {'items': [1, 2], 'item': 'outer'}
+        self.try_render('{% for item in items %}{{ item }}{% endfor %}\
+{{ item }}', ctx, '12outer')
+        self.assertEqual(ctx, {'items': [1, 2], 'item': 'outer'})
+
+    def test_nested_for_index(self):
+        self.try_render('{% for row in rows %}{% for cell in row %}\
+{{ index }}{% endfor %}{{ index }};{% endfor %}',
+                        {'rows': [[1, 2], [3]]}, '010;01;')
+
+    def test_loop_variable(self):
+        self.try_render('{% for item in items %}{{ loop.index }}/\
+{{ loop.length }}{% if loop.first %}F{% endif %}{% if loop.last %}L\
+{% endif %} {% endfor %}', {'items': iter('abc')}, '0/3F 1/3 2/3L ')
+
+    def test_loop_variable_attribute(self):
+        obj = AnyOldObject(a='Any')
+        self.try_render('{% for o in objs %}{{ o.a }}{{ o.func }}{% endfor %}',
+                        {'objs': [obj, obj]}, 'Anyfunc!Anyfunc!')
+
+    def test_if_operators(self):
+        for cond, result in (('num == 6', 'y'), ('num != 6', 'n'),
+                             ('num <= 5', 'n'), ('num >= 6', 'y'),
+                             ('none is None', 'y'), ('num is None', 'n'),
+                             ('num is not None', 'y'), ('0 < 1', 'y'),
+                             ('"a" == "b"', 'n'), ('num < 10', 'y')):
+            self.try_render('{% if ' + cond + ' %}y{% else %}n{% endif %}',
+                            {'num': 6, 'none': None}, result)
+
+    def test_if_values_are_not_evaluated(self):
+        # Context values are compared as they are, never parsed.
+        self.try_render('{% if num > 1 %}y{% else %}n{% endif %}',
+                        {'num': 0}, 'n')
+        self.try_render('{% if word == "1" %}y{% endif %}',
+                        {'word': '1'}, 'y')
+
+    def test_if_syntax(self):
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{% if a <> b %}{% endif %}')
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{% if a is so b %}{% endif %}')
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{% if a b %}{% endif %}')
+
+    def test_filters(self):
+        self.try_render('{{ name|lower|capitalize }}', {'name': 'mANISH'},
+                        'Manish')
+        self.try_render('{{ text | truncate(8, "..") }}|\
+{{ items|join(", ") }}', {'text': 'Hello, World', 'items': [1, 2]},
+                        'Hello,..|1, 2')
+        self.try_render('{{ missing.name|default("n/a") }}', {}, 'n/a')
+        self.try_render('{% for item in items %}{{ item.a|upper }}\
+{% endfor %}', {'items': [AnyOldObject(a='x'), {'a': 'y'}]}, 'XY')
+        self.try_render('{{ "a|b"|replace("|", "-")|upper }}', {}, 'A-B')
+
+    def test_filter_errors(self):
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{{ name|nope }}')
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{{ name|truncate(length) }}')
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{{ name|truncate(3 }}')
+
+    def test_stream(self):
+        template = Tortoise('<ul>{% for item in items %}<li>{{ item }}</li>\
+{% endfor %}</ul>{% if items %}!{% else %}?{% endif %}')
+        ctx = {'items': [1, 2, 3]}
+        chunks = list(template.stream(ctx))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), template.render(ctx))
+        self.assertEqual(list(Tortoise('').stream()), [])
+
+    def test_render_to(self):
+        template = Tortoise('{% for item in items %}<p>{{ item }}</p>\
+{% endfor %}')
+        ctx = {'items': range(100)}
+        sink = Sink()
+        template.render_to(ctx, sink, buffer_size=100)
+        self.assertEqual(sink.getvalue(), template.render(ctx))
+        self.assertTrue(all(len(w) >= 100 for w in sink.writes[:-1]))
+        sink = Sink()
+        template.render_to(ctx, sink, buffer_size=0)
+        self.assertEqual(len(sink.writes), 300)
+
+    def test_whitespace_control(self):
+        self.try_render('<ul>\n  {%- for i in items %}\n  <li>{{ i -}}\
+  </li>\n  {%- endfor %}\n</ul>', {'items': [1, 2]},
+                        '<ul>\n  <li>1</li>\n  <li>2</li>\n</ul>')
+
+    def test_collapse_whitespace(self):
+        template = Tortoise('<ul>\n\n    {% for i in items %}\n\
+    <li>  {{ i }}  </li>{% endfor %}\n  </ul>', collapse_whitespace=True)
+        self.assertEqual(template.render({'items': ['a  b']}),
+                         '<ul>\n\n<li> a  b </li>\n</ul>')
+
+    def test_collapse_whitespace_spares_literals(self):
+        template = Tortoise('<p>  {{ "a    b" }}  \
+{% for s in ["x  y"] %} {{ s }}{% endfor %}</p>', collapse_whitespace=True)
+        self.assertEqual(template.render(), '<p> a    b  x  y</p>')
+
+    def test_pickle(self):
+        template = Tortoise('{% for item in items %}{{ item|upper }}\
+{% if item == "b" %}!{% endif %}{% endfor %}')
+        copy = pickle.loads(pickle.dumps(template))
+        ctx = {'items': ['a', 'b']}
+        self.assertEqual(copy.render(ctx), template.render(ctx))
+        self.assertEqual(copy.render(ctx), 'AB!')
+
+    def test_render_many(self):
+        template = Tortoise('<p>{{ name }}</p>')
+        contexts = [{'name': i} for i in range(50)]
+        expected = ['<p>{0}</p>'.format(i) for i in range(50)]
+        self.assertEqual(list(template.render_many(contexts)), expected)
+        self.assertEqual(
+            list(template.render_many(contexts, workers=2, chunksize=7)),
+            expected)
+        sinks = [Sink() for _ in contexts]
+        template.render_many_to(contexts, sinks, workers=2)
+        self.assertEqual([sink.getvalue() for sink in sinks], expected)
+
+
+class LexerTest(TestCase):
+
+    def test_tokens(self):
+        tokens = list(Lexer('<h1>{{ name }}</h1>{% if x %}{%endif%}'))
+        self.assertEqual(
+            [(t.type, t.clean()) for t in tokens],
+            [(TOKEN_HTML, '<h1>'), (TOKEN_VAR, 'name'), (TOKEN_HTML, '</h1>'),
+             (TOKEN_BLOCK, 'if x'), (TOKEN_BLOCK_END, 'endif')])
+        self.assertEqual(tokens[3].keyword, 'if')
+
+    def test_line_and_column(self):
+        tokens = list(Lexer('<ul>\n  {% for i in items %}\n    {{ i }}\n\
+{% endfor %}</ul>'))
+        self.assertEqual(
+            [(t.line_no, t.col_no) for t in tokens],
+            [(1, 1), (2, 3), (2, 23), (3, 5), (3, 12), (4, 1), (4, 13)])
+
+    def test_leading_whitespace(self):
+        # The whitespace around the template is dropped, but counted.
+        tokens = list(Lexer('\n\n  <p>\n{{ x }}\n  '))
+        self.assertEqual(
+            [(t.value, t.line_no, t.col_no) for t in tokens],
+            [('<p>\n', 3, 3), ('{{ x }}', 4, 1)])
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Tortoise('\n  {% if %}')
+        self.assertIn('line 2, column 3', str(cm.exception))
+
+    def test_whitespace_control(self):
+        tokens = list(Lexer('<ul>\n  {%- for i in items -%}\n  <li>\
+{{- i }} </li>\n  {%- endfor %}\n</ul>'))
+        self.assertEqual(
+            [(t.value, t.clean(), t.line_no, t.col_no) for t in tokens],
+            [('<ul>', '<ul>', 1, 1),
+             ('{%- for i in items -%}', 'for i in items', 2, 3),
+             ('<li>', '<li>', 3, 3),
+             ('{{- i }}', 'i', 3, 7),
+             (' </li>', ' </li>', 3, 15),
+             ('{%- endfor %}', 'endfor', 4, 3),
+             ('\n</ul>', '\n</ul>', 4, 16)])
+
+    def test_peek(self):
+        lexer = Lexer('a{{ b }}')
+        self.assertEqual(lexer.peek().clean(), 'a')
+        self.assertEqual([t.clean() for t in lexer], ['a', 'b'])
+
+
+class AccessorTest(TestCase):
+
+    def test_same_as_resolve(self):
+        obj = AnyOldObject(a={'b': AnyOldObject(c='see')})
+        ctx = {'obj': obj, 'name': 'Foo', 'empty': None}
+        for name in ('obj.a.b.c', 'obj.func', 'name', 'empty.x', 'nope.x'):
+            self.assertEqual(Accessor(name)(ctx), resolve(name, ctx))
+        with self.assertRaises(TemplateContextError):
+            Accessor('nope')(ctx)
+
+    def test_remembers_lookup_kind(self):
+        accessor = Accessor('row.name')
+        self.assertEqual(accessor({'row': {'name': 'a'}}), 'a')
+        self.assertEqual(accessor._kinds[0], {dict: 'item'})
+        self.assertEqual(accessor({'row': AnyOldObject(name='b')}), 'b')
+        self.assertEqual(accessor._kinds[0][AnyOldObject], 'attr')
+        # Objects of the same type that don't agree still work.
+        row = AnyOldObject()
+        row.__class__ = type('Row', (AnyOldObject,), {
+            '__getitem__': lambda self, key: key.upper()})
+        self.assertEqual(accessor({'row': row}), 'NAME')
+        self.assertNotIn(row.__class__, accessor._kinds[0])
+        row.name = 'c'
+        self.assertEqual(accessor({'row': row}), 'c')
+
+
+class TemplateDirTest(TestCase):
+    """
+    Base for tests that load templates from a temporary directory.
+    """
+
+    cache_size = 50
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.env = Environment(FileSystemLoader(self.path),
+                               cache_size=self.cache_size)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, text, mtime=None):
+        path = os.path.join(self.path, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+
+class FiltersTest(TestCase):
+
+    def test_constant_folding(self):
+        calls = []
+
+        @filters.register('count_calls')
+        def count_calls(value):
+            calls.append(value)
+            return value * 2
+        try:
+            template = Tortoise('{{ 21|count_calls }} {{ n|count_calls }}')
+            self.assertEqual(calls, [21])
+            self.assertEqual(template.render({'n': 1}), '42 2')
+            self.assertEqual(template.render({'n': 2}), '42 4')
+            self.assertEqual(calls, [21, 1, 2])
+        finally:
+            del filters.FILTERS['count_calls']
+
+    def test_chain(self):
+        chain = filters.parse('name|trim|truncate(4, "")|upper')[1]
+        self.assertEqual(chain('  tortoise '), 'TORT')
+        chain = pickle.loads(pickle.dumps(chain, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(chain('  tortoise '), 'TORT')
+
+    def test_split_pipes(self):
+        self.assertEqual(filters.split_pipes(r'a | b("|", "\"|") |c(")")'),
+                         ['a', r'b("|", "\"|")', 'c(")")'])
+
+
+class AutoescapeTest(TestCase):
+
+    def render(self, text, ctx=None):
+        results = set(Tortoise(text, compiled=compiled, autoescape=True)
+                      .render(ctx) for compiled in (True, False))
+        self.assertEqual(len(results), 1)
+        return results.pop()
+
+    def test_autoescape(self):
+        self.assertEqual(self.render('<p>{{ a }}{{ b }}</p>', {
+            'a': '<b>"Tom" & \'Jerry\'</b>', 'b': None}),
+            '<p>&lt;b&gt;&#34;Tom&#34; &amp; &#39;Jerry&#39;&lt;/b&gt;</p>')
+        self.assertEqual(self.render('{{ "<i>" }}{{ 1 }}'), '&lt;i&gt;1')
+        self.assertEqual(Tortoise('{{ a }}').render({'a': '<b>'}), '<b>')
+
+    def test_safe_values(self):
+        self.assertEqual(self.render('{{ a }}{{ b|safe }}{{ c|escape }}', {
+            'a': Markup('<b>'), 'b': '<i>', 'c': '<u>'}), '<b><i>&lt;u&gt;')
+        self.assertEqual(self.render('{% for i in items %}{{ i }}{% endfor %}',
+                                     {'items': ['a&b', 'a&b', 'c']}),
+                         'a&amp;ba&amp;bc')
+
+    def test_escape(self):
+        self.assertIsInstance(escape('plain'), Markup)
+        self.assertEqual(escape('<'), '&lt;')
+        self.assertEqual(escape(Markup('<')), '<')
+        escape_value = escaper()
+        self.assertEqual(escape_value('<a>'), '&lt;a&gt;')
+        self.assertIs(escape_value('<a>'), escape_value('<a>'))
+        self.assertEqual(escape_value(None), '')
+        self.assertEqual(escape_value(3), '3')
+
+
+class NodesTest(TestCase):
+
+    def test_slots(self):
+        root = parser.Parser('<p>{{ name }}</p>{% for i in items %}\
+{% if i %}{{ i }}{% else %}-{% endif %}{% endfor %}').generate_parse_tree()
+        nodes = list(walk(root))
+        self.assertFalse(any(hasattr(node, '__dict__') for node in nodes))
+        self.assertFalse(hasattr(root.children[0].token, '__dict__'))
+        self.assertIs(root.children[0].children, root.children[1].children)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(root, protocol))
+            self.assertEqual(copy.render(Context({'name': 'a', 'items': [0]})),
+                             '<p>a</p>-')
+
+
+class OptimizerTest(TestCase):
+
+    def optimize(self, text, autoescape=False):
+        return optimizer.optimize(
+            parser.Parser(text).generate_parse_tree(), autoescape)
+
+    def test_merge_html(self):
+        root = self.optimize('<p>{{ "a" }}b{% if 1 %}c{% else %}d\
+{% endif %}{{ None }}</p>')
+        self.assertEqual(len(root.children), 1)
+        self.assertEqual(str(root.children[0].token), '<p>abc</p>')
+
+    def test_prerender_loop(self):
+        text = '<ul>{% for i in [1, 2] %}<li>{{ i|upper }}:{{ loop.index }}\
+</li>{% endfor %}</ul>'
+        root = self.optimize(text)
+        self.assertEqual([str(child.token) for child in root.children],
+                         ['<ul><li>1:0</li><li>2:1</li></ul>'])
+        self.assertEqual(Tortoise(text).render(),
+                         '<ul><li>1:0</li><li>2:1</li></ul>')
+        root = self.optimize('{% for i in "<>" %}{{ i }}{% endfor %}', True)
+        self.assertEqual(str(root.children[0].token), '&lt;&gt;')
+
+    def test_keep_dynamic_loops(self):
+        root = self.optimize('{% for i in [1, 2] %}{{ name }}{% endfor %}\
+{% for i in [1] %}{% block a %}{{ i }}{% endblock %}{% endfor %}\
+{% for i in items %}x{% endfor %}')
+        self.assertEqual([type(child) for child in root.children],
+                         [For, For, For])
+        self.assertIsInstance(root.children[1].children[0], Block)
+
+    def test_find_names(self):
+        root = parser.Parser('{% for x in items %}{{ x.a }}{{ y.b|upper }}\
+{% if z > x %}{{ loop.index }}{% endif %}{% endfor %}{% if w %}{% endif %}\
+{{ "literal" }}').generate_parse_tree()
+        self.assertEqual(find_names(root), set(['items', 'y', 'z', 'w']))
+
+
+class ProfilerTest(TestCase):
+
+    text = '<ul>\n{% for item in items %}\n<li>{{ item|upper }}\
+{% if item == "b" %}!{% endif %}</li>{% endfor %}</ul>'
+
+    def test_profile(self):
+        seen = []
+        profiler = Profiler(lambda key, seconds: seen.append(key))
+        template = Tortoise(self.text, name='list.html', profiler=profiler)
+        self.assertEqual(template.render({'items': ['a', 'b']}),
+                         '<ul>\n\n<li>A</li>\n<li>B!</li></ul>')
+        stats = profiler.stats
+        self.assertEqual(
+            stats[('list.html', 2, 1, '{% for item in items %}')][0], 1)
+        self.assertEqual(
+            stats[('list.html', 3, 5, '{{ item|upper }}')][0], 2)
+        self.assertEqual(
+            stats[('list.html', 3, 21, '{% if item == "b" %}')][0], 2)
+        self.assertEqual(len(seen), 5)
+        entries = profiler.entries()
+        self.assertEqual(entries[0][0][3], '{% for item in items %}')
+        self.assertIn('list.html:2:1 {% for item in items %}',
+                      profiler.report())
+        profiler.reset()
+        self.assertEqual(profiler.entries(), [])
+
+    def test_extends_and_include(self):
+        path = tempfile.mkdtemp()
+        try:
+            for name, text in [
+                    ('base.html', '<main>\n{% block body %}{% endblock %}\n\
+{{ footer }}</main>'),
+                    ('row.html', '<li>{{ r }}</li>'),
+                    ('child.html', '{% extends "base.html" %}\
+{% block body %}{% for r in rows %}{% include "row.html" %}{% endfor %}\
+{% endblock %}')]:
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write(text)
+            profiler = Profiler()
+            env = Environment(FileSystemLoader(path), profiler=profiler)
+            env.get_template('child.html').render({'rows': [1, 2],
+                                                   'footer': 'f'})
+        finally:
+            shutil.rmtree(path)
+        keys = set(key[:3] for key in profiler.stats)
+        self.assertEqual(keys, set([('base.html', 3, 1), ('row.html', 1, 5),
+                                    ('child.html', 1, 42)]))
+
+    def test_pickle(self):
+        profiler = Profiler()
+        template = pickle.loads(pickle.dumps(
+            Tortoise('{{ a }}', profiler=profiler)))
+        self.assertEqual(template.render({'a': 1}), '1')
+        self.assertEqual(template.profiler.entries()[0][1], 1)
+
+    def test_no_profiler(self):
+        source = compiler.generate(parser.Parser(self.text)
+                                   .generate_parse_tree())[0]
+        self.assertNotIn('_timer', source)
+
+
+class Clock(object):
+    """
+    A timer that moves a second forward every time it is read.
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class BudgetTest(TestCase):
+
+    nested = '{% for x in items %}{% for y in items %}.{% endfor %}\
+{% endfor %}'
+
+    def render(self, text, budget, ctx, stream=False):
+        for compiled in (True, False):
+            template = Tortoise(text, compiled=compiled, budget=budget)
+            if stream:
+                ''.join(template.stream(ctx))
+            else:
+                template.render(ctx)
+
+    def test_iterations(self):
+        ctx = {'items': range(10)}
+        # 10 for the outer loop, 100 for the inner ones.
+        self.render(self.nested, Budget(iterations=110), ctx)
+        with self.assertRaises(TemplateBudgetExceeded) as cm:
+            self.render(self.nested, Budget(iterations=109), ctx)
+        self.assertEqual(cm.exception.budget, 'iterations')
+        self.assertEqual(str(cm.exception),
+                         'Render budget exceeded: more than 109 iterations')
+
+    def test_iterations_per_render(self):
+        template = Tortoise(self.nested, budget=Budget(iterations=110))
+        for _ in range(3):
+            self.assertEqual(len(template.render({'items': range(10)})), 100)
+
+    def test_output(self):
+        text = '{% for i in items %}<b>{{ i }}</b>{% endfor %}'
+        ctx = {'items': range(10)}
+        self.render(text, Budget(output=80), ctx)
+        self.render(text, Budget(output=80), ctx, stream=True)
+        for stream in (False, True):
+            with self.assertRaises(TemplateBudgetExceeded) as cm:
+                self.render(text, Budget(output=79), ctx, stream)
+            self.assertEqual(cm.exception.budget, 'output')
+
+    def test_output_outside_loops(self):
+        with self.assertRaises(TemplateBudgetExceeded):
+            self.render('{{ text }}', Budget(output=5), {'text': 'x' * 6})
+
+    def test_cached_output(self):
+        text = '{% cache "k" %}{{ text }}{% endcache %}'
+        for compiled in (True, False):
+            fragments = LRUCache()
+            fragments.set('k', 'x' * 100)
+            template = Tortoise(text, compiled=compiled,
+                                fragment_cache=fragments,
+                                budget=Budget(output=5))
+            self.assertRaises(TemplateBudgetExceeded, template.render,
+                              {'text': 'y'})
+            self.assertRaises(TemplateBudgetExceeded, list,
+                              template.stream({'text': 'y'}))
+            if tortoise.aio is not None:
+                self.assertRaises(TemplateBudgetExceeded, run,
+                                  template.render_async({'text': 'y'}))
+
+    def test_seconds(self):
+        ctx = {'items': range(100)}
+        self.render(self.nested, Budget(seconds=1e6, timer=Clock()), ctx)
+        with self.assertRaises(TemplateBudgetExceeded) as cm:
+            self.render(self.nested, Budget(seconds=50, timer=Clock()), ctx)
+        self.assertEqual(cm.exception.budget, 'seconds')
+
+    def test_generators(self):
+        def endless():
+            while True:
+                yield 1
+        text = '{% for i in items %}{{ i }}{% endfor %}'
+        for budget in (Budget(iterations=10),
+                       Budget(seconds=50, timer=Clock())):
+            with self.assertRaises(TemplateBudgetExceeded):
+                self.render(text, budget, {'items': Lazy(endless)})
+            if tortoise.aio is not None:
+                template = Tortoise(text, budget=budget)
+                self.assertRaises(TemplateBudgetExceeded, run,
+                                  template.render_async({'items': endless()}))
+        self.render(text, Budget(iterations=3), {'items': Lazy(
+            lambda: (i for i in range(3)))})
+
+    def test_error_type(self):
+        template = Tortoise(self.nested, budget=Budget(iterations=1))
+        self.assertRaises(TemplateError, template.render, {'items': [1, 2]})
+
+    def test_environment(self):
+        env = Environment(None, budget=Budget(iterations=1))
+        template = env.from_string(self.nested)
+        self.assertRaises(TemplateBudgetExceeded, template.render,
+                          {'items': [1, 2]})
+
+    @skipIf(tortoise.aio is None, 'render_async needs Python 3.5+')
+    def test_async(self):
+        template = Tortoise(self.nested, budget=Budget(iterations=5))
+        self.assertRaises(TemplateBudgetExceeded, run,
+                          template.render_async({'items': [1, 2, 3]}))
+
+    def test_no_budget(self):
+        source = compiler.generate(parser.Parser(self.nested)
+                                   .generate_parse_tree())[0]
+        self.assertNotIn('_m', source)
+
+
+@skipIf(tortoise.aio is None, 'render_async needs Python 3.5+')
+class AsyncRenderTest(TestCase):
+
+    def test_awaitables(self):
+        template = Tortoise('{{ user.name }} {{ user.profile.city }}\
+{% for post in posts %}<p>{{ loop.index }}:{{ post|upper }}</p>{% endfor %}')
+        user = AnyOldObject(name=Deferred('Jane'),
+                            profile=Deferred({'city': Deferred('Paris')}))
+        ctx = {'user': Deferred(user),
+               'posts': functools.partial(asyncio.sleep, 0, ['a', 'b'])}
+        self.assertEqual(run(template.render_async(ctx)),
+                         'Jane Paris<p>0:A</p><p>1:B</p>')
+        self.assertEqual(ctx['user'].awaited, 1)
+
+    def test_coroutine_functions(self):
+        template = Tortoise('{{ a }} {{ b }} {{ c }}')
+        ctx = {'a': functools.partial(asyncio.sleep, 0, 'partial'),
+               'b': AsyncCallable(), 'c': AsyncCallable}
+        self.assertEqual(run(template.render_async(ctx)),
+                         'partial called ' + str(AsyncCallable))
+
+    def test_dotted_calls(self):
+        calls = []
+
+        def load():
+            calls.append(1)
+            return Deferred('loaded')
+        template = Tortoise('{{ user.load }}{% for i in [1, 2] %}\
+{{ user.load }}{% endfor %}')
+        user = AnyOldObject(load=load)
+        self.assertEqual(run(template.render_async({'user': user})),
+                         'loaded' * 3)
+        self.assertEqual(calls, [1])
+
+    def test_cancel_on_error(self):
+        template = Tortoise('{{ slow }}{{ user.slow }}{{ missing }}')
+        ctx = {'slow': Deferred('s', 10),
+               'user': AnyOldObject(slow=lambda: Deferred('u', 10))}
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertRaises(TemplateContextError, loop.run_until_complete,
+                              template.render_async(ctx))
+            # Let the cancellations go through.
+            loop.run_until_complete(asyncio.sleep(0))
+            all_tasks = getattr(asyncio, 'all_tasks', None) or \
+                asyncio.Task.all_tasks
+            self.assertEqual([task for task in all_tasks(loop)
+                              if not task.done()], [])
+        finally:
+            loop.close()
+
+    def test_lazy(self):
+        template = Tortoise('{% if show %}{{ stats }}{% else %}-{% endif %}')
+        stats = Deferred(42)
+        self.assertEqual(run(template.render_async(
+            {'show': Deferred(False), 'stats': stats})), '-')
+        self.assertEqual(stats.awaited, 0)
+        self.assertEqual(run(template.render_async(
+            {'show': True, 'stats': stats})), '42')
+
+    def test_concurrent(self):
+        template = Tortoise('{{ a }}{% if b %}{{ c }}{% endif %}')
+        ctx = dict((name, Deferred(name, 0.1)) for name in 'abc')
+        start = timeit.default_timer()
+        self.assertEqual(run(template.render_async(ctx)), 'ac')
+        self.assertLess(timeit.default_timer() - start, 0.25)
+
+    def test_same_as_render(self):
+        text = '{% for i in items %}{% if i > 1 %}{{ i }}{% else %}\
+<{{ name }}>{% endif %}{% endfor %}'
+        template = Tortoise(text, autoescape=True)
+        ctx = {'items': [1, 2, 3], 'name': 'b'}
+        self.assertEqual(run(template.render_async(ctx)),
+                         template.render(ctx))
+        self.assertRaises(TemplateContextError, run,
+                          Tortoise('{{ missing }}').render_async({}))
+
+    def test_cache(self):
+        template = Tortoise('{% cache "a-{key}" %}{{ counter.next }}\
+{% endcache %}')
+        ctx = {'key': Deferred('k'), 'counter': Counter()}
+        self.assertEqual(run(template.render_async(ctx)), '1')
+        self.assertEqual(run(template.render_async(ctx)), '1')
+        self.assertEqual(template.fragment_cache.get('a-k'), '1')
+
+
+class EnvironmentTest(TemplateDirTest):
+
+    cache_size = 2
+
+    def test_get_template(self):
+        self.write('hello.html', 'Hello, {{ name }}')
+        template = self.env.get_template('hello.html')
+        self.assertEqual(template.name, 'hello.html')
+        self.assertEqual(template.render({'name': 'Foo'}), 'Hello, Foo')
+        self.assertIs(self.env.get_template('hello.html'), template)
+
+    def test_not_found(self):
+        self.write('hello.html', 'Hello')
+        with self.assertRaises(TemplateNotFound):
+            self.env.get_template('missing.html')
+        with self.assertRaises(TemplateNotFound):
+            self.env.get_template('../hello.html')
+
+    def test_reload_on_change(self):
+        self.write('page.html', 'one', mtime=1000)
+        template = self.env.get_template('page.html')
+        # Same size, newer file.
+        self.write('page.html', 'two', mtime=2000)
+        self.assertEqual(self.env.get_template('page.html').render(), 'two')
+        # Same mtime, different size.
+        self.write('page.html', 'three', mtime=2000)
+        self.assertEqual(self.env.get_template('page.html').render(), 'three')
+        self.assertIsNot(self.env.get_template('page.html'), template)
+
+    def test_eviction(self):
+        for name in ('a', 'b', 'c'):
+            self.write(name, name)
+        a = self.env.get_template('a')
+        self.env.get_template('b')
+        self.env.get_template('a')
+        self.env.get_template('c')
+        self.assertEqual(sorted(self.env.cache.keys()), ['a', 'c'])
+        self.assertIs(self.env.get_template('a'), a)
+
+
+class IncludeTest(TemplateDirTest):
+
+    def setUp(self):
+        super(IncludeTest, self).setUp()
+        self.write('row.html', '<li>{{ item }}</li>', mtime=1000)
+        self.write('page.html', '<ul>{% for item in items %}\
+{% include "row.html" %}{% endfor %}</ul>', mtime=1000)
+
+    def test_include(self):
+        for compiled in (True, False):
+            self.env.compiled = compiled
+            self.env.cache.clear()
+            page = self.env.get_template('page.html')
+            self.assertEqual(page.render({'items': [1, 2]}),
+                             '<ul><li>1</li><li>2</li></ul>')
+            # The included tree is shared, not copied.
+            include = page.root.children[1].children[0]
+            self.assertIs(include.children,
+                          self.env.get_template('row.html').root.children)
+
+    def test_dynamic(self):
+        self.write('other.html', '<p>{{ item }}</p>')
+        template = self.env.from_string('{% for item in items %}\
+{% include partial %}{% endfor %}')
+        for partial in ('row.html', 'other.html'):
+            ctx = {'items': [1], 'partial': partial}
+            self.assertEqual(''.join(template.stream(ctx)),
+                             template.render(ctx))
+        self.assertEqual(template.render(ctx), '<p>1</p>')
+
+    def test_reload(self):
+        page = self.env.get_template('page.html')
+        self.write('row.html', '<li>{{ item }}!</li>', mtime=2000)
+        self.assertEqual(self.env.reload(), ['row.html', 'page.html'])
+        self.assertEqual(self.env.get_template('page.html')
+                         .render({'items': [1]}), '<ul><li>1!</li></ul>')
+        self.assertEqual(page.render({'items': [1]}), '<ul><li>1</li></ul>')
+
+    def test_errors(self):
+        with self.assertRaises(TemplateError):
+            Tortoise('{% include "row.html" %}')
+        with self.assertRaises(TemplateError):
+            Tortoise('{% include name %}').render({'name': 'row.html'})
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{% include 1 %}')
+        self.write('a.html', '{% include "b.html" %}')
+        self.write('b.html', '{% include "a.html" %}')
+        with self.assertRaises(TemplateError):
+            self.env.get_template('a.html')
+
+
+class LazyContextTest(TemplateDirTest):
+
+    def test_lazy(self):
+        calls = []
+        stats = Lazy(lambda: calls.append(1) or len(calls))
+        for compiled in (True, False):
+            del calls[:]
+            template = Tortoise('{% if show %}{{ stats }}\
+{% for i in [1, 2] %}{{ stats }}{% endfor %}{% endif %}', compiled=compiled)
+            self.assertEqual(template.render({'show': False,
+                                              'stats': stats}), '')
+            self.assertEqual(calls, [])
+            self.assertEqual(template.render({'show': True,
+                                              'stats': stats}), '111')
+            self.assertEqual(template.render({'show': True,
+                                              'stats': stats}), '222')
+
+    def test_context_processors(self):
+        calls = []
+        self.env.context_processors.append(lambda: {
+            'site': 'Site', 'user': Lazy(lambda: calls.append(1) or 'U')})
+        self.write('page.html', '{{ site }}/{{ title }}\
+{% if title == "Home" %}/{{ user }}{% endif %}')
+        template = self.env.get_template('page.html')
+        self.assertEqual(template.render({'title': 'About'}), 'Site/About')
+        self.assertEqual(calls, [])
+        self.assertEqual(template.render({'title': 'Home', 'site': 'Mine'}),
+                         'Mine/Home/U')
+        self.assertEqual(calls, [1])
+
+    def test_referenced_names(self):
+        self.write('row.html', '{{ item.name }}{{ currency }}')
+        template = self.env.from_string('{{ title|upper }}\
+{% for item in items %}{% include "row.html" %}{% endfor %}\
+{% if user is not None %}{{ user.name }}{% endif %}')
+        self.assertEqual(template.referenced_names,
+                         frozenset(['title', 'items', 'currency', 'user']))
+
+
+class IncrementalTest(TemplateDirTest):
+
+    text = '<h1>{{ title }}</h1>{% for row in rows %}<li>{{ row }}</li>\
+{% endfor %}<p>{{ counter.next }}</p>'
+
+    def test_render(self):
+        for compiled in (True, False):
+            session = Tortoise(self.text, compiled=compiled).session()
+            counter = Counter()
+            ctx = {'title': 'A', 'rows': [1, 2], 'counter': counter}
+            self.assertEqual(session.render(ctx),
+                             '<h1>A</h1><li>1</li><li>2</li><p>1</p>')
+            ctx = dict(ctx, title='B', rows=[1, 2])
+            self.assertEqual(session.render(ctx),
+                             '<h1>B</h1><li>1</li><li>2</li><p>1</p>')
+            self.assertEqual(counter.count, 1)
+            session.reset()
+            self.assertEqual(session.render(ctx),
+                             '<h1>B</h1><li>1</li><li>2</li><p>2</p>')
+
+    def test_changes(self):
+        session = Tortoise(self.text).session()
+        ctx = {'title': 'A', 'rows': [1], 'counter': Counter()}
+        self.assertEqual(len(session.changes(ctx)), len(session.parts))
+        self.assertEqual(session.changes(ctx), [])
+        ctx = dict(ctx, rows=[1, 2])
+        changes = session.changes(ctx)
+        self.assertEqual([html for _, html in changes],
+                         ['<li>1</li><li>2</li>'])
+        # Equal values and names the template doesn't use change nothing.
+        self.assertEqual(session.changes(dict(ctx, title='A', other=1)), [])
+
+    def test_missing_names(self):
+        session = Tortoise('{% if user.name %}{{ user.name }}{% endif %}!')\
+            .session()
+        self.assertEqual(session.render({}), '!')
+        self.assertEqual(session.render({'user': {'name': 'me'}}), 'me!')
+        self.assertEqual(session.render({}), '!')
+
+    def test_blocks_and_includes(self):
+        self.write('base.html', '{% block head %}{{ title }}{% endblock %}\
+{% block body %}{% endblock %}')
+        self.write('row.html', '<i>{{ counter.next }}</i>')
+        self.write('page.html', '{% extends "base.html" %}\
+{% block body %}<b>{{ name }}</b>{% include "row.html" %}{% endblock %}')
+        session = self.env.get_template('page.html').session()
+        ctx = {'title': 'T', 'name': 'n', 'counter': Counter()}
+        self.assertEqual(session.render(ctx), 'T<b>n</b><i>1</i>')
+        self.assertEqual(session.render(dict(ctx, title='U', name='m')),
+                         'U<b>m</b><i>1</i>')
+
+    def test_dynamic_include(self):
+        self.write('row.html', '<i>{{ counter.next }}</i>')
+        session = self.env.from_string('{% include name %}').session()
+        ctx = {'name': 'row.html', 'counter': Counter()}
+        self.assertEqual(session.render(ctx), '<i>1</i>')
+        self.assertEqual(session.render(ctx), '<i>2</i>')
+
+
+class ThreadSafetyTest(TemplateDirTest):
+    """
+    One template rendered from many threads at once, each with contexts
+    of its own, must give every thread its own output.
+    """
+
+    threads = 8
+    renders = 30
+
+    text = '{% for row in rows %}<tr class="{{ loop.index }}">\
+{% for cell in row.cells %}<td>{{ cell|upper }}{% if cell == owner %}*\
+{% endif %}</td>{% endfor %}</tr>{% endfor %}\
+{% cache "foot-{owner}" %}<p>{{ owner }}</p>{% endcache %}\
+{% include part %}'
+
+    def setUp(self):
+        TemplateDirTest.setUp(self)
+        self.write('a.html', '<i>{{ owner }}</i>')
+        self.write('b.html', '<b>{{ rows|length }}</b>')
+        # Switch threads as often as possible, to get them to interleave.
+        if hasattr(sys, 'setswitchinterval'):
+            self.interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:
+            self.interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+
+    def tearDown(self):
+        if hasattr(sys, 'setswitchinterval'):
+            sys.setswitchinterval(self.interval)
+        else:
+            sys.setcheckinterval(self.interval)
+        TemplateDirTest.tearDown(self)
+
+    def context(self, thread, render):
+        owner = 't{0}'.format(thread)
+        rows = [{'cells': [owner, 'r{0}'.format(render), 'c{0}'.format(i)]}
+                for i in range(render % 4 + 1)]
+        return {'rows': rows, 'owner': owner,
+                'part': 'a.html' if render % 2 else 'b.html'}
+
+    def stress(self, template):
+        expected = {}
+        for thread in range(self.threads):
+            for render in range(self.renders):
+                expected[thread, render] = template.render(
+                    self.context(thread, render))
+        wrong = []
+
+        def work(thread):
+            for render in range(self.renders):
+                ctx = self.context(thread, render)
+                if render % 3 == 0:
+                    html = ''.join(template.stream(ctx))
+                else:
+                    html = template.render(ctx)
+                if html != expected[thread, render]:
+                    wrong.append((thread, render, html))
+
+        threads = [threading.Thread(target=work, args=(thread,))
+                   for thread in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(wrong, [])
+
+    def test_compiled(self):
+        self.stress(self.env.from_string(self.text))
+
+    def test_tree(self):
+        self.env.compiled = False
+        self.stress(self.env.from_string(self.text))
+
+    def test_autoescape(self):
+        self.env.autoescape = True
+        self.stress(self.env.from_string(self.text + '{{ "<>" }}'))
+
+    def test_tree_unchanged(self):
+        # Renders leave the parse tree as they found it.
+        template = self.env.from_string(self.text, name='page.html')
+        before = pickle.dumps(template.root, 2)
+        self.stress(template)
+        self.assertEqual(pickle.dumps(template.root, 2), before)
+
+    def test_profiler(self):
+        profiler = Profiler()
+        template = Tortoise('{% for row in rows %}{{ owner }}{% endfor %}',
+                            profiler=profiler)
+        self.stress(template)
+        # Each context is rendered once up front, and once in a thread.
+        rows = sum(render % 4 + 1 for render in range(self.renders))
+        calls = [calls for key, calls, _ in profiler.entries()
+                 if key[3] == '{{ owner }}']
+        self.assertEqual(calls, [2 * self.threads * rows])
+
+
+class ReloadTest(TemplateDirTest):
+
+    def setUp(self):
+        super(ReloadTest, self).setUp()
+        self.write('base.html', '<b>{% block body %}{% endblock %}</b>',
+                   mtime=1000)
+        self.write('child.html', '{% extends "base.html" %}\
+{% block body %}child{% endblock %}', mtime=1000)
+        self.write('other.html', 'other', mtime=1000)
+        self.templates = dict((name, self.env.get_template(name))
+                              for name in ('child.html', 'other.html'))
+
+    def test_reload_dependents(self):
+        child = self.templates['child.html']
+        self.write('base.html', '<i>{% block body %}{% endblock %}</i>',
+                   mtime=2000)
+        self.assertEqual(self.env.get_template('child.html').render(),
+                         '<i>child</i>')
+        self.assertIs(self.env.get_template('other.html'),
+                      self.templates['other.html'])
+        # A render with the old template is left alone.
+        self.assertEqual(child.render(), '<b>child</b>')
+
+    def test_reload(self):
+        self.assertEqual(self.env.reload(), [])
+        self.write('base.html', '<i>{% block body %}{% endblock %}</i>',
+                   mtime=2000)
+        self.assertEqual(sorted(self.env.reload()),
+                         ['base.html', 'child.html'])
+        self.env.auto_reload = False
+        self.assertEqual(self.env.get_template('child.html').render(),
+                         '<i>child</i>')
+        self.assertIs(self.env.get_template('other.html'),
+                      self.templates['other.html'])
+
+    def test_watch(self):
+        self.env.auto_reload = False
+        stop = self.env.watch(0.01)
+        try:
+            self.write('other.html', 'changed', mtime=2000)
+            for _ in range(200):
+                if self.env.get_template('other.html').render() == 'changed':
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.env.get_template('other.html').render(),
+                             'changed')
+        finally:
+            stop.set()
+
+    def test_reload_errors(self):
+        self.write('child.html', '{% if %}', mtime=2000)
+        self.write('other.html', 'changed', mtime=2000)
+        self.assertEqual(self.env.reload(), ['other.html'])
+        self.assertIsInstance(self.env.errors['child.html'],
+                              TemplateSyntaxError)
+        self.env.auto_reload = False
+        # The old template is still served.
+        self.assertEqual(self.env.get_template('child.html').render(),
+                         '<b>child</b>')
+        self.write('child.html', '{% extends "base.html" %}\
+{% block body %}fixed{% endblock %}', mtime=3000)
+        self.assertEqual(self.env.reload(), ['child.html'])
+        self.assertEqual(self.env.errors, {})
+        self.assertEqual(self.env.get_template('child.html').render(),
+                         '<b>fixed</b>')
+
+    def test_reload_missing(self):
+        os.remove(os.path.join(self.path, 'other.html'))
+        self.assertEqual(self.env.reload(), [])
+        self.assertIsInstance(self.env.errors['other.html'],
+                              TemplateNotFound)
+        self.write('other.html', 'back', mtime=2000)
+        self.assertEqual(self.env.reload(), ['other.html'])
+
+    def test_watch_errors(self):
+        self.env.auto_reload = False
+        stop = self.env.watch(0.01)
+        try:
+            self.write('other.html', '{% if %}', mtime=2000)
+            for _ in range(200):
+                if 'other.html' in self.env.errors:
+                    break
+                time.sleep(0.01)
+            self.assertIn('other.html', self.env.errors)
+            self.write('other.html', 'fixed', mtime=3000)
+            for _ in range(200):
+                if self.env.get_template('other.html').render() == 'fixed':
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.env.get_template('other.html').render(),
+                             'fixed')
+        finally:
+            stop.set()
+
+
+class BytecodeCacheTest(TestCase):
+
+    text = '{% for o in objs %}{% if o.a == "Any" %}{{ o.func }}\
+{% endif %}{% endfor %}'
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.bcc = FileSystemBytecodeCache(self.path)
+        self.ctx = {'objs': [AnyOldObject(a='Any'), AnyOldObject(a='No')]}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @skipIf(not hasattr(os, 'getuid'), 'needs user ids')
+    def test_unsafe_directory(self):
+        os.chmod(self.path, 0o777)
+        self.assertRaises(TemplateError, FileSystemBytecodeCache, self.path)
+        # A directory that turns unsafe later on is not read from.
+        key = Tortoise(self.text, bytecode_cache=self.bcc).key
+        os.chmod(self.path, 0o700)
+        self.assertIsNotNone(self.bcc.load(key))
+        os.chmod(self.path, 0o770)
+        self.assertIsNone(self.bcc.load(key))
+
+    @skipIf(not hasattr(os, 'getuid'), 'needs user ids')
+    def test_default_directory(self):
+        bcc = FileSystemBytecodeCache()
+        self.assertIn(str(os.getuid()), bcc.directory)
+        self.assertTrue(bcc.is_safe())
+
+    def load_without_parsing(self, **kwargs):
+        generate_parse_tree = parser.Parser.generate_parse_tree
+
+        def fail(self):
+            raise AssertionError('Template parsed again!')
+        parser.Parser.generate_parse_tree = fail
+        try:
+            return Tortoise(self.text, bytecode_cache=self.bcc, **kwargs)
+        finally:
+            parser.Parser.generate_parse_tree = generate_parse_tree
+
+    def test_load(self):
+        for compiled in (True, False):
+            template = Tortoise(self.text, bytecode_cache=self.bcc,
+                                compiled=compiled)
+            cached = self.load_without_parsing(compiled=compiled)
+            self.assertEqual(cached.render(self.ctx), 'func!')
+            self.assertEqual(cached.render(self.ctx),
+                             template.render(self.ctx))
+        self.assertEqual(len(os.listdir(self.path)), 2)
+
+    def test_broken_entry(self):
+        Tortoise(self.text, bytecode_cache=self.bcc)
+        for filename in os.listdir(self.path):
+            with open(os.path.join(self.path, filename), 'w') as f:
+                f.write('garbage')
+        template = Tortoise(self.text, bytecode_cache=self.bcc)
+        self.assertEqual(template.render(self.ctx), 'func!')
+        self.load_without_parsing()
+
+    def test_key(self):
+        key = self.bcc.get_key(self.text, None, True)
+        self.assertEqual(key, self.bcc.get_key(self.text, None, True))
+        self.assertNotEqual(key, self.bcc.get_key(self.text, None, False))
+        self.assertNotEqual(key, self.bcc.get_key(self.text + ' ', None, True))
+
+
+class InheritanceTest(TemplateDirTest):
+
+    def setUp(self):
+        super(InheritanceTest, self).setUp()
+        self.write('base.html', '<title>{% block title %}Base{% endblock %}\
+</title>{% block body %}{% for i in items %}{% block item %}{{ i }}\
+{% endblock %}{% endfor %}{% endblock %}!')
+
+    def test_extends(self):
+        self.write('child.html', '{% extends "base.html" %}ignored\
+{% block title %}Child of {{ name }}{% endblock %}')
+        ctx = {'name': 'base', 'items': [1, 2]}
+        self.assertEqual(self.env.get_template('child.html').render(ctx),
+                         '<title>Child of base</title>12!')
+        self.assertEqual(self.env.get_template('base.html').render(ctx),
+                         '<title>Base</title>12!')
+
+    def test_nested_blocks(self):
+        self.write('child.html', '{% extends "base.html" %}\
+{% block item %}<{{ i }}>{% endblock %}')
+        self.write('grandchild.html', '{% extends "child.html" %}\
+{% block title %}Grand{% endblock %}')
+        for compiled in (True, False):
+            self.env.compiled = compiled
+            self.env.cache.clear()
+            template = self.env.get_template('grandchild.html')
+            self.assertEqual(template.render({'items': [1, 2]}),
+                             '<title>Grand</title><1><2>!')
+        # The tree is flattened, with the parts that didn't change shared.
+        self.assertIs(template.root.children[0],
+                      self.env.get_template('base.html').root.children[0])
+
+    def test_errors(self):
+        with self.assertRaises(TemplateError):
+            Tortoise('{% extends "base.html" %}')
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{% extends base %}')
+        with self.assertRaises(TemplateSyntaxError):
+            Tortoise('{% block a %}{% endblock %}{% block a %}{% endblock %}')
+        self.write('self.html', '{% extends "self.html" %}')
+        with self.assertRaises(TemplateError):
+            self.env.get_template('self.html')
+
+    def test_bytecode_cache(self):
+        self.write('child.html', '{% extends "base.html" %}\
+{% block body %}Body{% endblock %}')
+        bcc = FileSystemBytecodeCache(os.path.join(self.path, 'cache'))
+        env = Environment(FileSystemLoader(self.path), bytecode_cache=bcc)
+        self.assertEqual(env.get_template('child.html').render(),
+                         '<title>Base</title>Body!')
+        self.write('base.html', '{% block body %}{% endblock %}?')
+        env = Environment(FileSystemLoader(self.path), bytecode_cache=bcc)
+        self.assertEqual(env.get_template('child.html').render(), 'Body?')
+
+
+class LRUCacheTest(TestCase):
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+        with self.assertRaises(KeyError):
+            cache['b']
+
+    def test_ttl(self):
+        now = [0]
+        cache = LRUCache(10, ttl=10, timer=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=20)
+        cache.set('c', 3, ttl=5)
+        now[0] = 5
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, None))
+        now[0] = 15
+        self.assertNotIn('a', cache)
+        self.assertEqual((cache.get('a'), cache.get('b')), (None, 2))
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def next(self):
+        self.count += 1
+        return self.count
+
+
+class FragmentCacheTest(TestCase):
+
+    text = '<nav>{% cache "nav-{user.id}" 60 %}{{ counter.next }}\
+{% cache "inner" %}[{{ counter.next }}]{% endcache %}{% endcache %}</nav>'
+
+    def test_cache(self):
+        for compiled in (True, False):
+            counter = Counter()
+            template = Tortoise(self.text, compiled=compiled)
+            for render in (template.render,
+                           lambda ctx: ''.join(template.stream(ctx))):
+                user = AnyOldObject(id=1)
+                ctx = {'user': user, 'counter': counter}
+                self.assertEqual(render(ctx), '<nav>1[2]</nav>')
+                self.assertEqual(render(ctx), '<nav>1[2]</nav>')
+                user.id = 2
+                self.assertEqual(render(ctx), '<nav>3[2]</nav>')
+                template.fragment_cache.clear()
+                counter.count = 0
+
+    def test_ttl(self):
+        now = [0]
+        fragments = LRUCache(10, timer=lambda: now[0])
+        template = Tortoise(self.text, fragment_cache=fragments)
+        ctx = {'user': AnyOldObject(id=1), 'counter': Counter()}
+        self.assertEqual(template.render(ctx), '<nav>1[2]</nav>')
+        now[0] = 61
+        self.assertEqual(template.render(ctx), '<nav>3[2]</nav>')
+
+    def test_no_cache(self):
+        template = Tortoise('{% cache key %}{{ counter.next }}{% endcache %}')
+        self.assertIsInstance(template.fragment_cache, LRUCache)
+        self.assertIsNone(Tortoise('{{ a }}').fragment_cache)
+        template.fragment_cache = None
+        ctx = {'key': 'a', 'counter': Counter()}
+        self.assertEqual(template.render(ctx) + template.render(ctx), '12')
+
+    def test_errors(self):
+        for text in ('{% cache %}', '{% cache 1 %}', '{% cache "a" b %}'):
+            with self.assertRaises(TemplateSyntaxError):
+                Tortoise(text + '{% endcache %}')
+
+
+class TortoiseTreeRendererTest(TortoiseTest):
+    """
+    Run all of the above again through the parse tree renderer,
+    which has to agree with the compiled templates.
+    """
+
+    def setUp(self):
+        self._compiled = Tortoise.compiled
+        Tortoise.compiled = False
+
+    def tearDown(self):
+        Tortoise.compiled = self._compiled
+
+    def test_renderers_agree(self):
+        text = '{% for item in items %}{{ index }}:\
+{% if item > 1 %}{{ item }}{% else %}-{% endif %}{% endfor %}'
+        ctx = {'items': [1, 2, 3]}
+        self.assertEqual(Tortoise(text, compiled=True).render(dict(ctx)),
+                         Tortoise(text, compiled=False).render(dict(ctx)))
+        self.assertEqual(Tortoise(text).render(ctx), '0:-1:22:3')
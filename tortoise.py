@@ -1,15 +1,320 @@
+import marshal
+import multiprocessing
+
 import parser
+import compiler
+import incremental
+import markup
+import optimizer
+from cache import LRUCache
+from context import Context
+from nodes import Cache, find_extends, find_blocks, find_includes, \
+    find_names, inherit, link_includes, walk
+from exc import TemplateError
+
+try:
+    import aio
+except SyntaxError:
+    # async/await needs Python 3.5 or later.
+    aio = None
+
+__version__ = '0.1.0'
+
+# The number of fragments kept for a template that has {% cache %}
+# blocks, unless it is given a fragment cache.
+FRAGMENT_CACHE_SIZE = 100
 
 
 class Tortoise(object):
 
-    def __init__(self, text):
+    # Render through a compiled Python function by default, the
+    # parse tree renderer is kept around as a fallback.
+    compiled = True
+
+    # The (path, state) of the files the template was built from, its
+    # own and those of the templates it depends on. The Environment
+    # sets these, to tell when the template needs to be loaded again.
+    files = ()
+
+    def __init__(self, text, compiled=None, name=None, env=None,
+                 bytecode_cache=None, autoescape=False, profiler=None,
+                 collapse_whitespace=False, fragment_cache=None,
+                 context_processors=(), budget=None):
         self.text = text
-        self.root = parser.Parser(self.text).generate_parse_tree()
+        # The name the template was loaded by, and the Environment
+        # that loaded it, if any.
+        self.name = name
+        self.env = env
+        self.compiled = self.compiled if compiled is None else compiled
+        # HTML escape the value of every Variable?
+        self.autoescape = autoescape
+        # Squeeze the runs of whitespace in the HTML when parsing?
+        self.collapse_whitespace = collapse_whitespace
+        # Where {% cache %} blocks keep their output: anything with
+        # `get(key)` and `set(key, value, ttl)`, like an LRUCache.
+        self.fragment_cache = fragment_cache
+        # Functions whose dicts of values every render gets, under the
+        # values it is given.
+        self.context_processors = context_processors
+        # The limits of every render, a budget.Budget.
+        self.budget = budget
+        # Profiling is compiled into the render function, so profiled
+        # templates are always compiled.
+        self.profiler = profiler
+        if profiler is not None:
+            self.compiled = True
+        self.load(bytecode_cache)
+        self.prepare()
+
+    def prepare(self):
+        """
+        Set up the functions that do the rendering.
+        """
+        if self.fragment_cache is None and \
+                any(isinstance(node, Cache) for node in walk(self.root)):
+            self.fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+        if self.compiled:
+            self._render, self._stream = compiler.load(
+                self._code, self._namespace, _profiler=self.profiler)
+        else:
+            self._render = self.root.render
+            self._stream = self.root.stream
+
+    def __getstate__(self):
+        # Ship the template without what can't be pickled: the render
+        # functions are set up again, code objects go through marshal.
+        # The tree is flattened already, and the Environment stays
+        # with the process that loaded the template, along with the
+        # fragment cache.
+        state = self.__dict__.copy()
+        for key in ('_render', '_stream', 'env', 'parent', 'includes',
+                    'fragment_cache'):
+            del state[key]
+        if self._code is not None:
+            state['_code'] = marshal.dumps(self._code)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.env = self.parent = self.fragment_cache = None
+        self.includes = []
+        if self._code is not None:
+            self._code = marshal.loads(self._code)
+        self.prepare()
+
+    def load(self, bytecode_cache=None):
+        """
+        Parse (and compile) the template, unless the bytecode cache
+        already has the result.
+
+        A template that extends another one is flattened into a single
+        tree along with its parents, and the trees of the templates it
+        includes by name are linked in. The cache keeps the parse tree
+        of such a template by itself, and the flattened and compiled
+        result under a key that covers the templates it depends on,
+        since it goes stale along with them.
+        """
+        cache = bytecode_cache
+        cached = self.key = None
+        if cache is not None:
+            self.key = cache.get_key(self.text, self.name, *self.options())
+            cached = cache.load(self.key)
+        if cached is None:
+            root = optimizer.optimize(
+                parser.Parser(self.text).generate_parse_tree(),
+                self.autoescape, self.collapse_whitespace)
+            # The trees of other templates get merged into this one,
+            # tokens tell where each node came from.
+            for node in walk(root):
+                if node.token is not None:
+                    node.token.template = self.name
+            code = namespace = None
+        else:
+            root, code, namespace = cached
+
+        self.parent = None
+        self.includes = []
+        extends = find_extends(root)
+        # Only what is in the blocks of a template that extends another
+        # one is kept.
+        includes = find_includes(find_blocks(root).values()
+                                 if extends is not None else [root])
+        if extends is not None or includes:
+            if cached is None and cache is not None:
+                cache.dump(self.key, root)
+            if extends is not None:
+                self.parent = self.get_template(extends.parent, 'extend')
+            self.includes = [self.get_template(name, 'include')
+                             for name in includes]
+            cached = None
+            if cache is not None:
+                self.key = cache.get_key(self.key, *[
+                    template.key for template in self.dependencies()])
+                cached = cache.load(self.key)
+            if cached is None:
+                if self.parent is not None:
+                    root = inherit(self.parent.root, root)
+                root = link_includes(root, dict(
+                    (template.name, template) for template in self.includes))
+            else:
+                root, code, namespace = cached
+
+        if cached is None:
+            if self.compiled:
+                code, namespace = compiler.compile_tree(
+                    root, self.name or '<template>', self.autoescape,
+                    self.profiler is not None, self.budget is not None)
+            if cache is not None:
+                cache.dump(self.key, root, code, namespace)
+        self.root, self._code, self._namespace = root, code, namespace
+        # The names the template looks up in the context. Those of
+        # templates included by a name from the context aren't known.
+        self.referenced_names = frozenset(find_names(root))
+
+    def dependencies(self):
+        """
+        The templates that went into this one.
+        """
+        parent = [self.parent] if self.parent is not None else []
+        return parent + self.includes
+
+    def options(self):
+        """
+        The options that make a difference to the compiled template.
+        """
+        return (self.compiled, self.autoescape, self.profiler is not None,
+                self.collapse_whitespace, self.budget is not None)
+
+    def get_template(self, name, action='extend'):
+        """
+        Return the template called `name`, which this one extends or
+        includes, as `action` says.
+        """
+        if self.env is None:
+            raise TemplateError(
+                'Cannot {0} "{1}": no Environment to load it from'
+                .format(action, name))
+        if name == self.name:
+            raise TemplateError(
+                'Template "{0}" {1}s itself'.format(name, action))
+        return self.env.get_template(name)
+
+    def new_context(self, ctx=None):
+        """
+        Return the Context for a single render with `ctx`.
+        """
+        escape = markup.escaper() if self.autoescape else None
+        meter = self.budget.start() if self.budget is not None else None
+        if not self.context_processors:
+            return Context(ctx, escape, self.fragment_cache, self.env, meter)
+        values = {}
+        for processor in self.context_processors:
+            values.update(processor())
+        context = Context(values, escape, self.fragment_cache, self.env,
+                          meter)
+        context.push({} if ctx is None else ctx)
+        return context
 
     def render(self, ctx=None):
-        ctx = ctx or {}
-        return self.root.render(ctx)
+        return self._render(self.new_context(ctx))
+
+    def stream(self, ctx=None):
+        """
+        Generator of the rendered template in chunks, so the first
+        bytes can go out before the whole page is rendered.
+        """
+        return self._stream(self.new_context(ctx))
+
+    def render_context(self, context):
+        """
+        Render the template with a Context that is set up already, like
+        that of the template that includes this one.
+        """
+        return self._render(context)
+
+    def stream_context(self, context):
+        return self._stream(context)
+
+    def session(self):
+        """
+        Return an incremental.RenderSession, which renders the template
+        again and again redoing only the parts whose values changed.
+        """
+        return incremental.RenderSession(self)
+
+    def render_async(self, ctx=None):
+        """
+        Coroutine that renders the template with a context whose values
+        may be awaitables or coroutine functions, see `aio`. Needs
+        Python 3.5 or later, and renders with the parse tree, without
+        profiling.
+        """
+        if aio is None:
+            raise TemplateError('render_async needs Python 3.5 or later')
+        return aio.render(self.root, self.new_context(ctx))
+
+    def render_to(self, ctx, fp, buffer_size=8192):
+        """
+        Render the template into the file-like object `fp`.
+        Chunks are collected into writes of at least `buffer_size`
+        characters, a `buffer_size` of 0 writes every chunk right away.
+        """
+        buf, size = [], 0
+        for chunk in self.stream(ctx):
+            if not chunk:
+                continue
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                fp.write(''.join(buf))
+                buf, size = [], 0
+        if buf:
+            fp.write(''.join(buf))
+
+    def render_many(self, contexts, workers=None, chunksize=100):
+        """
+        Render the template with each context in `contexts`, return an
+        iterator of the results, in the same order.
+
+        With more than one of `workers`, the contexts are rendered by a
+        pool of that many processes, which get the template once when
+        they start, and the contexts in batches of `chunksize`. Contexts
+        and results have to be picklable then.
+        """
+        if not workers or workers <= 1:
+            return (self.render(ctx) for ctx in contexts)
+        return self._render_pool(contexts, workers, chunksize)
+
+    def _render_pool(self, contexts, workers, chunksize):
+        pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        try:
+            for result in pool.imap(_render_in_worker, contexts, chunksize):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def render_many_to(self, contexts, sinks, workers=None, chunksize=100):
+        """
+        Like `render_many`, but write each result to the file-like
+        object at the same position in `sinks`.
+        """
+        results = self.render_many(contexts, workers, chunksize)
+        for result, sink in zip(results, sinks):
+            sink.write(result)
+
+
+# The template a pool worker renders, see Tortoise.render_many().
+_worker_template = None
+
+
+def _init_worker(template):
+    global _worker_template
+    _worker_template = template
+
+
+def _render_in_worker(ctx):
+    return _worker_template.render(ctx)
 
 
 if __name__ == '__main__':
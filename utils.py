@@ -3,6 +3,40 @@
 import ast
 from exc import TemplateContextError
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def get_slots(cls):
+    """
+    The names in the `__slots__` of `cls` and all of its bases.
+    """
+    names = []
+    for klass in cls.__mro__:
+        names.extend(klass.__dict__.get('__slots__', ()))
+    return names
+
+
+class Slotted(object):
+    """
+    Base of the objects a parsed template is made of. They keep their
+    attributes in `__slots__` rather than a `__dict__` each, which
+    takes a fraction of the memory, and still pickle (with any pickle
+    protocol) and copy like any other object.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name))
+                    for name in get_slots(type(self)) if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
 
 def resolve(token, context):
     """
@@ -40,8 +74,127 @@ def do_dots(token, context):
     return rv
 
 
+# How a step of an Accessor found its value last time.
+_ATTR = 'attr'
+_ITEM = 'item'
+
+
+class Accessor(object):
+    """
+    A lookup of a (possibly dotted) name in a context, worked out once
+    at parse time. Calling it gives the same result as `resolve`:
+
+        Accessor('obj.a')(context) == resolve('obj.a', context)
+
+    For a dotted name, every step of the path remembers whether an
+    object of a given type had the name as an attribute or as an item.
+    The next object of the same type goes straight for that kind of
+    lookup, and only falls back to trying both if that fails. Item
+    lookups are only remembered for objects without a `__dict__`
+    (dicts, lists and the like), since any other object could grow
+    the attribute later on.
+
+    What is remembered is only a hint, so renders in other threads may
+    write it at the same time: a single dict assignment, the last
+    one wins, and any kind that turns out wrong is tried again.
+    """
+
+    __slots__ = ('name', 'head', 'path', '_kinds')
+
+    def __init__(self, name):
+        self.name = name
+        parts = name.split('.')
+        self.head = parts[0]
+        self.path = tuple(parts[1:])
+        self._kinds = tuple({} for _ in self.path)
+
+    def __call__(self, context):
+        if not self.path:
+            try:
+                return context[self.head]
+            except KeyError:
+                raise TemplateContextError(self.name)
+        return self.walk(context.get(self.head, None))
+
+    def walk(self, rv):
+        """
+        Follow the dotted path starting from the value `rv`.
+        """
+        if rv:
+            for name, kinds in zip(self.path, self._kinds):
+                rv = lookup(rv, name, kinds)
+                if callable(rv):
+                    rv = rv()
+        return rv
+
+    def __getstate__(self):
+        # What we learnt about the types we've seen stays behind.
+        return self.name
+
+    def __setstate__(self, name):
+        self.__init__(name)
+
+    def __repr__(self):
+        return '<Accessor {0}>'.format(self.name)
+
+
+class Constant(Slotted):
+    """
+    A literal value, which can be called just like an Accessor.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, context):
+        return self.value
+
+    def __repr__(self):
+        return '<Constant {0!r}>'.format(self.value)
+
+
+def operand(expr):
+    """
+    Turn the expression `expr` into a Constant or an Accessor.
+    """
+    expr_type, value = eval_expression(expr)
+    if expr_type == 'literal':
+        return Constant(value)
+    return Accessor(value)
+
+
+def lookup(obj, name, kinds):
+    """
+    `obj.name`, or `obj[name]` if there is no such attribute.
+    `kinds` maps types to the kind of lookup that worked for them.
+    """
+    cls = type(obj)
+    kind = kinds.get(cls)
+    if kind is _ITEM:
+        try:
+            return obj[name]
+        except (LookupError, TypeError):
+            pass
+    elif kind is _ATTR:
+        try:
+            return getattr(obj, name)
+        except AttributeError:
+            pass
+    try:
+        rv = getattr(obj, name)
+    except AttributeError:
+        rv = obj[name]
+        if not hasattr(obj, '__dict__'):
+            kinds[cls] = _ITEM
+    else:
+        kinds[cls] = _ATTR
+    return rv
+
+
 def eval_expression(expr):
     try:
         return 'literal', ast.literal_eval(expr)
-    except ValueError or IndentationError or SyntaxError:
+    except (ValueError, SyntaxError):
         return 'name', expr